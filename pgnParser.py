@@ -6,12 +6,36 @@
 ##############################################################################################
 
 from __future__ import print_function
-import sys, re
+import sys, re, os, stat
 from subprocess import Popen, PIPE
-from time import sleep 
+from time import sleep, time
 import select
 from optparse import OptionParser
 import logging
+import struct
+from array import array
+import random
+import mmap
+import heapq
+import json
+from collections import OrderedDict
+from itertools import count
+import threading
+import socket
+from Queue import Queue, PriorityQueue
+from StringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from urlparse import urlparse, parse_qs
+try :
+    import numpy
+except ImportError :
+    numpy = None
+try :
+    import pyarrow
+    import pyarrow.parquet
+except ImportError :
+    pyarrow = None
 
 class SyntaxError( Exception ):
     """When we run into an unexpected token, this is the exception to use"""
@@ -21,7 +45,7 @@ class SyntaxError( Exception ):
         self.msg = msg
 
     def __str__(self):
-        if not self.pos:
+        if self.pos == None:
             return 'SyntaxError'
         else:
             return 'SyntaxError@%s (%s)' % (repr(self.pos), self.msg)
@@ -34,21 +58,36 @@ class BoardException( Exception ) :
     def __str__(self):
         return self.msg
 
+class EngineException( Exception ) :
+    def __init__(self, msg = "Engine failed" ):
+        Exception.__init__( self )
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
 ##############################################################################################################
 
 class ChessMove( object ) :
     def __init__( self, whiteMoveString ):
         self.move = whiteMoveString
         self.scoreCP = None
+        # numeric annotation glyph of a classified move, e.g. 2 for '?'
+        self.nag = None
         self.variation = None
+        self.refutation = None
         self.comments = list()
 
     def __repr__( self ) :
         s = "%s" % ( self.move if self.move else "" )
+        if self.nag != None :
+            s += " $%s" % ( self.nag )
         if self.scoreCP != None :
             s += " {%.1f}" % ( self.scoreCP )
         if self.variation :
             s += " ( %s )" % ( self.variation )
+        if self.refutation :
+            s += " ( %s )" % ( self.refutation )
         return s
         
 
@@ -80,10 +119,23 @@ class ChessGame( object ) :
         self.tags = list()
         self.moves = list()
         self.lastMove = None
+        self.result = None
+        # number, offset and line of the game in its input, set by PgnParser.games()
+        self.index = None
+        self.offset = None
+        self.line = None
+
+    TAG_PAIR = re.compile( r'\[\s*(\w+)\s+"(.*)"\s*\]' )
 
     def addTag( self, tag ) :
         self.tags.append( tag )
 
+    def tagPairs( self ) :
+        for tag in self.tags :
+            m = self.TAG_PAIR.match( tag )
+            if m :
+                yield ( m.group( 1 ), m.group( 2 ) )
+
     # TODO: ignore comments in first step and add them later
     def addMove( self, moveNumber, whiteMove, blackMove ) :
         if self.lastMove == None or self.lastMove.moveNumber != moveNumber :
@@ -95,6 +147,17 @@ class ChessGame( object ) :
             if blackMove :
                 self.lastMove.blackMove( blackMove )
 
+    def plies( self ) :
+        for move in self.moves :
+            if move.white :
+                yield ( move.moveNumber, "w", move.white )
+            if move.black :
+                yield ( move.moveNumber, "b", move.black )
+
+    def scores( self ) :
+        # per ply scores in pawns from white's point of view, nan where a ply was not analyzed
+        return [ chessMove.scoreCP if chessMove.scoreCP != None else float( "nan" ) for ( moveNumber, color, chessMove ) in self.plies() ]
+
     def stream( self, file ) :
         for move in self.moves :
             print( "%s" % move, file = file )
@@ -102,21 +165,35 @@ class ChessGame( object ) :
 ##############################################################################################################    
 
 class Scanner( object ) :
-    READ_BLOCK_SIZE = 4096
-    def __init__( self, filename ) :
-        self.grabInput( filename )
+    # white space, escape lines starting with '%' and rest of line comments starting with ';'
+    IGNORED = re.compile( r'(?:\s+|^%[^\n]*|;[^\n]*)+', re.MULTILINE )
+
+    def __init__( self, filename = None, text = None ) :
+        if text != None :
+            self.input = text
+        else :
+            self.grabInput( filename )
         self.scanPosition = 0
-        self.ignored = re.compile( r'\s+' )
+        self.ignored = self.IGNORED
+        # last ( offset, line ) computed, errors are reported in input order so line numbers
+        # are counted incrementally from there
+        self.lineMark = ( 0, 1 )
         pass
 
     def grabInput( self, filename ) :
-        self.input = ""
         f = open( filename, "r" )
-        data = f.read( self.READ_BLOCK_SIZE )
-        while data :
-            self.input = self.input + data
-            data = f.read( self.READ_BLOCK_SIZE )
+        self.input = f.read()
+        f.close()
     
+    def accept( self, regularExpression ) :
+        # scan if the next token matches, None otherwise
+        self.ignore()
+        m = regularExpression.match( self.input, self.scanPosition )
+        if m :
+            self.scanPosition = m.end()
+            return m.group( 0 )
+        return None
+
     def peek( self, regularExpression ) :
         self.ignore()
         m = regularExpression.match( self.input, self.scanPosition )
@@ -131,7 +208,24 @@ class Scanner( object ) :
             self.scanPosition = m.end()
             return m.group( 0 )
         else :
-            raise SyntaxError( self.scanPosition, regularExpression )
+            raise SyntaxError( self.scanPosition, "expected %s" % regularExpression.pattern )
+
+    def atEnd( self ) :
+        self.ignore()
+        return self.scanPosition >= len( self.input )
+
+    def skipTo( self, regularExpression, position ) :
+        # continue after the next match, the end of the input if there is none
+        m = regularExpression.search( self.input, position )
+        self.scanPosition = m.end() if m else len( self.input )
+
+    def lineNumber( self, position ) :
+        ( markPosition, markLine ) = self.lineMark
+        if position < markPosition :
+            ( markPosition, markLine ) = ( 0, 1 )
+        line = markLine + self.input.count( "\n", markPosition, position )
+        self.lineMark = ( position, line )
+        return line
 
     def ignore( self ) :
         m = self.ignored.match( self.input, self.scanPosition )
@@ -141,21 +235,53 @@ class Scanner( object ) :
             
 ##############################################################################################################    
 
+class ParseError( object ) :
+    """A game skipped by PgnParser.games(), offset is the position in the input"""
+    def __init__( self, gameIndex, offset, line, message, text ) :
+        self.gameIndex = gameIndex
+        self.offset = offset
+        self.line = line
+        self.message = message
+        self.text = text
+
+    def toDict( self ) :
+        return { "game" : self.gameIndex, "offset" : self.offset, "line" : self.line,
+                 "message" : self.message, "text" : self.text }
+
+    def __repr__( self ) :
+        return "offset %s line %s: %s at %r" % ( self.offset, self.line, self.message, self.text )
+
+def saveErrorReport( errors, filename ) :
+    f = open( filename, "w" )
+    for error in errors :
+        f.write( json.dumps( error.toDict(), sort_keys = True ) + "\n" )
+    f.close()
+
 class PgnParser( object ) :
-    TAGTEXT = re.compile( r"\[[^\]]*\]" )
+    # a tag pair at the start of a line begins a new game, no tag, comment or variation
+    # extends over it, so an unclosed bracket costs only the game it is in
+    NEWGAME = r'\n\s*\[\s*\w+\s+"'
+    TAGTEXT = re.compile( r"\[[^\]\n]*\]" )
+    TAGSTART = re.compile( r"\[" )
     COMMENT1START = re.compile( r'\(' )
     COMMENT1END = re.compile( r'\)' )
-    COMMENT2START = re.compile( r'{' )
-    COMMENT2END = re.compile( r'}' )
-    COMMENTTEXT = re.compile( r'[^{}()]+' )
+    BRACECOMMENTSTART = re.compile( r'{' )
+    BRACECOMMENT = re.compile( r'{(?:[^}\n]|(?!%s)\n)*}' % NEWGAME )
+    COMMENTTEXT = re.compile( r'(?:[^{}()\n]|(?!%s)\n)+' % NEWGAME )
     MOVENUMBER = re.compile( r"[0-9]+\." )
-    PIECEMOVE = re.compile( r"[KQBNR]?[a-h]?[1-8]?x?[a-h][1-8][+#]?[!?]?[!?]?|O-O|O-O-O" )
-    PIECEPLACEHOLDER = re.compile( r'\.\.' )
+    PIECEMOVE = re.compile( r"(?:[KQBNR]?[a-h]?[1-8]?x?[a-h][1-8](?:=?[QRBN])?|O-O-O|O-O)[+#]?[!?]?[!?]?" )
+    PIECEPLACEHOLDER = re.compile( r'\.\.\.?' )
+    NAG = re.compile( r'\$[0-9]+' )
     GAMERESULT = re.compile( r'1-0|0-1|\*|1/2-1/2' )
+    # where the parser picks up again after an error: before a tag pair at the start of a line
+    # or after a game result followed by an empty line
+    GAMEBOUNDARY = re.compile( r'^(?=\[\s*\w+\s+")|(?<=\s)(?:1-0|0-1|1/2-1/2|\*)(?=[ \t]*\n[ \t]*\n)', re.MULTILINE )
+    TAGSECTION = re.compile( r'(?:\s*\[[^\]\n]*\])*' )
     
     def __init__( self, scanner ) :
         self.scanner = scanner
         self.chessGame = ChessGame()
+        self.errors = list()
 
     def game( self ) :
         self.tags()
@@ -163,9 +289,49 @@ class PgnParser( object ) :
         self.moves()
         return self.chessGame
 
+    def completeGame( self ) :
+        # a game followed by its result, the end of the input or the tags of the next game
+        self.scanner.ignore()
+        startPosition = self.scanner.scanPosition
+        self.chessGame = ChessGame()
+        game = self.game()
+        game.result = self.scanner.accept( self.GAMERESULT )
+        if self.scanner.scanPosition == startPosition :
+            raise SyntaxError( startPosition, "No game found" )
+        if not game.result and not self.scanner.atEnd() and not self.scanner.peek( self.TAGTEXT ) :
+            raise SyntaxError( self.scanner.scanPosition, "Unexpected token" )
+        return game
+
+    def games( self ) :
+        # a game with a syntax error is skipped up to the next game boundary and recorded in self.errors
+        gameIndex = 0
+        while not self.scanner.atEnd() :
+            startPosition = self.scanner.scanPosition
+            try :
+                game = self.completeGame()
+            except SyntaxError as e :
+                self.errors.append( ParseError( gameIndex, e.pos, self.scanner.lineNumber( e.pos ), e.msg,
+                                                self.scanner.input[ e.pos : e.pos + 20 ] ) )
+                logging.warning( "skipping game %s: %s" % ( gameIndex, self.errors[ -1 ] ) )
+                # search from behind the tags of the failed game, the error may be past
+                # the start of the next game
+                tagSection = self.TAGSECTION.match( self.scanner.input, startPosition )
+                self.scanner.skipTo( self.GAMEBOUNDARY, max( tagSection.end(), startPosition + 1 ) )
+                gameIndex += 1
+                continue
+            game.index = gameIndex
+            game.offset = startPosition
+            game.line = self.scanner.lineNumber( startPosition )
+            gameIndex += 1
+            yield game
+
     def tags( self ) :
-        while self.scanner.peek( self.TAGTEXT ) :
-            self.tag()
+        tagtext = self.scanner.accept( self.TAGTEXT )
+        while tagtext :
+            self.chessGame.addTag( tagtext )
+            tagtext = self.scanner.accept( self.TAGTEXT )
+        if self.scanner.peek( self.TAGSTART ) :
+            raise SyntaxError( self.scanner.scanPosition, "Unclosed tag" )
 
 
     def tag( self ) :
@@ -176,50 +342,54 @@ class PgnParser( object ) :
     def moves( self ) :
         m = self.move()
         while m :
-            logging.debug( "Move: %s %s %s" % m )
+            logging.debug( "Move: %s %s %s", *m )
             m = self.move()
 
     def move( self ) :
         # logging.debug( "Scan moves" )
-        if not self.scanner.peek( self.MOVENUMBER ) :
+        moveNumber = self.scanner.accept( self.MOVENUMBER )
+        if not moveNumber :
             return None
-        moveNumber = self.scanner.scan( self.MOVENUMBER )
         moveNumber = moveNumber[:-1]
         comment = self.comments()
         if comment :
             logging.debug( "Comment: %s" % comment )
             pass
-        if self.scanner.peek( self.PIECEPLACEHOLDER ) :
-           self.scanner.scan( self.PIECEPLACEHOLDER )
+        if self.scanner.accept( self.PIECEPLACEHOLDER ) :
            comment = self.comments()
            if comment :
                # logging.debug( "Comment: %s" % comment )
                pass
            pieceMoveBlack = self.scanner.scan( self.PIECEMOVE )
-           comment = self.comments()
-           if comment :
-               logging.debug( "Comment: %s" % comment )
-               pass
+           blackComments = self.commentList()
            self.chessGame.addMove( moveNumber, None, pieceMoveBlack )
+           self.chessGame.lastMove.black.comments.extend( blackComments )
            return ( moveNumber, None, pieceMoveBlack )
         else :
            pieceMoveWhite = self.scanner.scan( self.PIECEMOVE )
-           comment = self.comments()
-           if comment :
-               logging.debug( "Comment: %s" % comment )
-               pass
-           if self.scanner.peek( self.PIECEMOVE ) :
-               pieceMoveBlack = self.scanner.scan( self.PIECEMOVE )
-               comment = self.comments()
-               if comment :
-                   # logging.debug( "Comment: %s" % comment )
-                   pass
+           whiteComments = self.commentList()
+           pieceMoveBlack = self.scanner.accept( self.PIECEMOVE )
+           if pieceMoveBlack :
+               blackComments = self.commentList()
                self.chessGame.addMove( moveNumber, pieceMoveWhite, pieceMoveBlack )
+               self.chessGame.lastMove.white.comments.extend( whiteComments )
+               self.chessGame.lastMove.black.comments.extend( blackComments )
                return ( moveNumber, pieceMoveWhite, pieceMoveBlack )
            else :
                self.chessGame.addMove( moveNumber, pieceMoveWhite, None )
+               self.chessGame.lastMove.white.comments.extend( whiteComments )
                return ( moveNumber, pieceMoveWhite, None )
 
+    def commentList( self ) :
+        # the comments, variations and NAGs following a move, one entry each
+        l = list()
+        c = self.comment()
+        while c :
+            logging.debug( "Comment: %s", c )
+            l.append( c )
+            c = self.comment()
+        return l
+
     def comments( self ) :
         # logging.debug( "Scan comments" )
         c = None
@@ -237,13 +407,18 @@ class PgnParser( object ) :
         c1 = self.comment1()
         if c1:
             return c1
-        return self.comment2()
+        c2 = self.comment2()
+        if c2 :
+            return c2
+        # numeric annotation glyphs are kept together with the comments
+        return self.scanner.accept( self.NAG )
     
     def comment1( self ) :
         if not self.scanner.peek( self.COMMENT1START ) :
             # logging.debug( "Scan comment1: no start found" )
             return None
         # logging.debug( "Scan comment1" )
+        startPosition = self.scanner.scanPosition
         c = self.scanner.scan( self.COMMENT1START )
         matchFound = True
         while matchFound : 
@@ -255,33 +430,35 @@ class PgnParser( object ) :
             if c1 :
                 c = c + c1
                 matchFound = True
+        if not self.scanner.peek( self.COMMENT1END ) :
+            raise SyntaxError( startPosition, "Unclosed variation" )
         c = c + self.scanner.scan( self.COMMENT1END )
         # logging.debug( "Comment1: %s" % c )
         return c
 
     def comment2( self ) :
-        if not self.scanner.peek( self.COMMENT2START ) :
-            # logging.debug( "Scan comment2: no start found" )
-            return None
-        # logging.debug( "Scan comment2" )
-        c = self.scanner.scan( self.COMMENT2START )
-        matchFound = True
-        while matchFound : 
-            matchFound = False
-            if self.scanner.peek( self.COMMENTTEXT ) :
-                c = c + self.scanner.scan( self.COMMENTTEXT )
-                matchFound = True
-            c1 = self.comments()
-            if c1 :
-                c = c + c1
-                matchFound = True
-        c = c + self.scanner.scan( self.COMMENT2END )
+        # brace comments do not nest and may contain anything but '}'
+        c = self.scanner.accept( self.BRACECOMMENT )
+        if not c and self.scanner.peek( self.BRACECOMMENTSTART ) :
+            raise SyntaxError( self.scanner.scanPosition, "Unclosed comment" )
         # logging.debug( "Comment2: %s" % c )
         return c
 
 
 ##############################################################################################################    
 
+def createZobristKeys( seed = 0x5eed ) :
+    # fixed seed: the hashes end up in index files and have to be stable between runs
+    generator = random.Random( seed )
+    keys = dict()
+    for figure in "PNBRQKpnbrqk" :
+        keys[ figure ] = [ generator.getrandbits( 64 ) for i in xrange( 64 ) ]
+    blackToMove = generator.getrandbits( 64 )
+    # drawn after the keys above so hashes without castling and 'en passant' stay the same
+    castling = dict( ( right, generator.getrandbits( 64 ) ) for right in "KQkq" )
+    enPassant = [ 0 ] + [ generator.getrandbits( 64 ) for i in xrange( 8 ) ]
+    return ( keys, blackToMove, castling, enPassant )
+
 class Square( object ) :
     def __init__( self, color, figure ) :
         self.color = color
@@ -290,7 +467,10 @@ class Square( object ) :
 
 class Board( object ) :
    STARTPOS_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
-   PGN_MOVE_ENCODING = re.compile( r'([KQBNR]?)([a-h]?[1-8]?)(x?)([a-h][1-8])[+#]?[!?]?[!?]?' )
+   PGN_MOVE_ENCODING = re.compile( r'([KQBNR]?)([a-h]?[1-8]?)(x?)([a-h][1-8])(?:=?([QRBN]))?[+#]?[!?]?[!?]?' )
+   ( ZOBRIST_KEYS, ZOBRIST_BLACK_TO_MOVE, ZOBRIST_CASTLING, ZOBRIST_EN_PASSANT ) = createZobristKeys()
+   # castling rights lost when a move starts or ends on one of these squares
+   CASTLING_SQUARES = { "e1" : "KQ", "h1" : "K", "a1" : "Q", "e8" : "kq", "h8" : "k", "a8" : "q" }
 
    def __init__( self, cloneBoard = None ) :
        if cloneBoard :
@@ -343,6 +523,17 @@ class Board( object ) :
 
    def startPosition( self ) :
         self.readFen( self.STARTPOS_FEN )
+
+   def positionHash( self, color ) :
+       # color is the side to move, castling rights and 'en passant' are not tracked by the board
+       h = self.ZOBRIST_BLACK_TO_MOVE if color == "b" else 0
+       keys = self.ZOBRIST_KEYS
+       i = 0
+       for sq in self.squares :
+           if sq.figure != " " :
+               h ^= keys[ sq.figure ][ i ]
+           i += 1
+       return h
         
    def logPrint( self ) :
        s = "\n\n"
@@ -480,7 +671,7 @@ class Board( object ) :
 
    def movePgn( self, move, color ) :
        # white uppercase, black lowercase
-       algebraicMove = self.testCastlingPgn( move, color )
+       algebraicMove = self.testCastlingPgn( move.rstrip( "+#!?" ), color )
        if algebraicMove :
            return algebraicMove
 
@@ -492,6 +683,7 @@ class Board( object ) :
            fromFileAndRank = moveMatch.group( 2 )
            captures =  True if moveMatch.group( 3 ) == "x" else False
            toFileAndRank  = moveMatch.group( 4 )
+           promotion = moveMatch.group( 5 )
            logging.debug( "Move %s from %s to %s color %s" % ( coloredFigure, fromFileAndRank, toFileAndRank, color ) )
            dst = self.positionStringToTupple( toFileAndRank )
            srcHint = self.positionStringToTupple( fromFileAndRank )
@@ -501,106 +693,125 @@ class Board( object ) :
                raise BoardException( "No figure found" )
            elif len( squares ) == 1 :
                src = squares[ 0 ]
-               fromFileAndRank = self.positionTuppleToString( src )
-               self.setSquare( src, " " )
-               self.setSquare( dst, coloredFigure )
            else :
                for src in squares :
                    if srcHint[ 0 ] == src[ 0 ] and srcHint[ 1 ] == src[ 1 ] :
-                       fromFileAndRank = self.positionTuppleToString( src )
-                       self.setSquare( src, " " )
-                       self.setSquare( dst, coloredFigure )
                        break
                    elif srcHint[ 0 ] == src[ 0 ]  :
-                       fromFileAndRank = self.positionTuppleToString( src )
-                       self.setSquare( src, " " )
-                       self.setSquare( dst, coloredFigure )
                        break
                    elif srcHint[ 1 ] == src[ 1 ]  :
-                       fromFileAndRank = self.positionTuppleToString( src )
-                       self.setSquare( src, " " )
-                       self.setSquare( dst, coloredFigure )
                        break
-           algebraicMove = "%s%s" % ( fromFileAndRank, toFileAndRank )
+               else :
+                   raise BoardException( "Ambiguous move %s" % move )
+           algebraicMove = "%s%s" % ( self.positionTuppleToString( src ), toFileAndRank )
+           if promotion :
+               algebraicMove += promotion.lower()
+           self.applyAlgebraic( algebraicMove, color, 0 )
            logging.debug( "algebraicMove: %s" % algebraicMove )
            return algebraicMove
        raise BoardException( "Unknown move %s for %s" % ( move, color ) )
        return None
 
    
+   # castling in PGN and algebraic notation, the rook is moved by applyAlgebraic
+   CASTLING_PGN = { ( "w", "O-O" ) : "e1g1", ( "w", "O-O-O" ) : "e1c1", ( "b", "O-O" ) : "e8g8", ( "b", "O-O-O" ) : "e8c8" }
+   CASTLING_ALGEBRAIC = { "e1g1" : ( "K", "O-O" ), "e1c1" : ( "K", "O-O-O" ), "e8g8" : ( "k", "O-O" ), "e8c8" : ( "k", "O-O-O" ) }
+
    def testCastlingPgn( self, m, color ) :
-       if color == "w" and m == "O-O" :
-           self.setSquare( ( 5, 1 ), " " )
-           self.setSquare( ( 8, 1 ), " " )
-           self.setSquare( ( 7, 1 ), "K" )
-           self.setSquare( ( 6, 1 ), "R" )
-           return "e1g1"
-       elif color == "w" and m == "O-O-O" :
-           self.setSquare( ( 5, 1 ), " " )
-           self.setSquare( ( 1, 1 ), " " )
-           self.setSquare( ( 3, 1 ), "K" )
-           self.setSquare( ( 4, 1 ), "R" )
-           return "e1c1"
-       elif color == "b" and m == "O-O" :
-           self.setSquare( ( 5, 8 ), " " )
-           self.setSquare( ( 8, 8 ), " " )
-           self.setSquare( ( 7, 8 ), "k" )
-           self.setSquare( ( 6, 8 ), "r" )
-           return "e8g8" 
-       elif color == "b" and m == "O-O-O" :
-           self.setSquare( ( 5, 8 ), " " )
-           self.setSquare( ( 8, 8 ), " " )
-           self.setSquare( ( 3, 8 ), "k" )
-           self.setSquare( ( 4, 8 ), "r" )
-           return "e8c8" 
-       return None 
+       algebraicMove = self.CASTLING_PGN.get( ( color, m ) )
+       if algebraicMove :
+           self.applyAlgebraic( algebraicMove, color, 0 )
+       return algebraicMove
 
    
    def testCastlingAgebraic( self, m ) :
-       if m == "e1g1" and self.getSquare( ( 5, 1 ) ).figure == "K" :
-           self.setSquare( ( 5, 1 ), " " )
-           self.setSquare( ( 8, 1 ), " " )
-           self.setSquare( ( 7, 1 ), "K" )
-           self.setSquare( ( 6, 1 ), "R" )
-           return "O-O"
-       elif m == "e1c1" and self.getSquare( ( 5, 1 ) ).figure == "K" :
-           self.setSquare( ( 5, 1 ), " " )
-           self.setSquare( ( 1, 1 ), " " )
-           self.setSquare( ( 3, 1 ), "K" )
-           self.setSquare( ( 4, 1 ), "R" )
-           return "O-O-O"
-       elif m == "e8g8"  and self.getSquare( ( 5, 8 ) ).figure == "k" :
-           self.setSquare( ( 5, 8 ), " " )
-           self.setSquare( ( 8, 8 ), " " )
-           self.setSquare( ( 7, 8 ), "k" )
-           self.setSquare( ( 6, 8 ), "r" )
-           return "O-O"
-       elif m == "e8c8"  and self.getSquare( ( 5, 8 ) ).figure == "k" :
-           self.setSquare( ( 5, 8 ), " " )
-           self.setSquare( ( 8, 8 ), " " )
-           self.setSquare( ( 3, 8 ), "k" )
-           self.setSquare( ( 4, 8 ), "r" )
-           return "O-O-O"
+       castling = self.CASTLING_ALGEBRAIC.get( m )
+       if castling and self.getSquare( self.positionStringToTupple( m[ 0:2 ] ) ).figure == castling[ 0 ] :
+           self.applyAlgebraic( m, "w" if castling[ 0 ] == "K" else "b", 0 )
+           return castling[ 1 ]
        return None
 
    
+   def positionKey( self, color, castlingRights, enPassantFile ) :
+       # positionHash extended by the castling rights ( e.g. "KQkq" ) and the 'en passant' file
+       # ( 1 - 8, 0 for none ), the board itself does not track them
+       h = self.positionHash( color ) ^ self.ZOBRIST_EN_PASSANT[ enPassantFile ]
+       for right in castlingRights :
+           h ^= self.ZOBRIST_CASTLING[ right ]
+       return h
+
+   def updateCastlingRights( self, castlingRights, algebraicMove ) :
+       for square in ( algebraicMove[ 0:2 ], algebraicMove[ 2:4 ] ) :
+           lost = self.CASTLING_SQUARES.get( square )
+           if lost :
+               castlingRights = "".join( right for right in castlingRights if right not in lost )
+       return castlingRights
+
+   def enPassantFile( self, algebraicMove ) :
+       # file of a pawn double step that can be captured 'en passant' right after it was played
+       src = self.positionStringToTupple( algebraicMove[ 0:2 ] )
+       dst = self.positionStringToTupple( algebraicMove[ 2:4 ] )
+       figure = self.getSquare( dst ).figure
+       if figure.upper() != "P" or abs( dst[ 1 ] - src[ 1 ] ) != 2 :
+           return 0
+       enemyPawn = "p" if figure == "P" else "P"
+       for f in ( dst[ 0 ] - 1, dst[ 0 ] + 1 ) :
+           if f > 0 and f < 9 and self.getSquare( ( f, dst[ 1 ] ) ).figure == enemyPawn :
+               return dst[ 0 ]
+       return 0
+
+   def updateSquare( self, p, figure, h ) :
+       # set a square and return the position hash h updated for the change
+       i = ( p[ 1 ] - 1 ) * 8 + ( p[ 0 ] - 1 )
+       sq = self.squares[ i ]
+       if sq.figure != " " :
+           h ^= self.ZOBRIST_KEYS[ sq.figure ][ i ]
+       if figure != " " :
+           h ^= self.ZOBRIST_KEYS[ figure ][ i ]
+       sq.figure = figure
+       return h
+
+   def applyAlgebraic( self, m, color, h ) :
+       # play a move already known to be legal without searching for the source square,
+       # returns the position hash h for the other side to move. Every move played on the
+       # board ends up here, so castling, 'en passant' and promotions are handled the same
+       # whether a PGN move was cached or not
+       src = self.positionStringToTupple( m[0:2] )
+       dst = self.positionStringToTupple( m[2:4] )
+       coloredFigure = self.getSquare( src ).figure
+       if coloredFigure.upper() == "K" and abs( dst[ 0 ] - src[ 0 ] ) == 2 :
+           rookSrc = ( 8 if dst[ 0 ] == 7 else 1, src[ 1 ] )
+           rookDst = ( 6 if dst[ 0 ] == 7 else 4, src[ 1 ] )
+           h = self.updateSquare( rookDst, self.getSquare( rookSrc ).figure, h )
+           h = self.updateSquare( rookSrc, " ", h )
+       elif coloredFigure.upper() == "P" and dst[ 0 ] != src[ 0 ] and self.getSquare( dst ).figure == " " :
+           h = self.updateSquare( ( dst[ 0 ], src[ 1 ] ), " ", h )
+       if len( m ) > 4 :
+           coloredFigure = self.coloredFigure( m[ 4 ], color )
+       h = self.updateSquare( src, " ", h )
+       h = self.updateSquare( dst, coloredFigure, h )
+       return h ^ self.ZOBRIST_BLACK_TO_MOVE
+
    def moveAlgebraic( self, m, color ) :
        pgnString =  self.testCastlingAgebraic( m )
        if pgnString :
            return pgnString
 
        srcString = m[0:2]
-       dstString = m[2:]
+       dstString = m[2:4]
        src = self.positionStringToTupple( m[0:2] )
-       dst = self.positionStringToTupple( m[2:] )
+       dst = self.positionStringToTupple( m[2:4] )
        coloredFigure = self.getSquare( src ).figure
+       promotionString = ""
+       if len( m ) > 4 :
+           promotionString = "=" + m[ 4 ].upper()
        figure = coloredFigure.upper()
        figureDst = self.getSquare( dst ).figure.upper()
-       # TODO handle 'en passant'
        captures = figureDst != " "
-       captureString = "x" if captures else ""
        if figure == "P" and dst[ 0 ] != src[ 0 ] :
+           # also covers 'en passant' where the destination square is empty
            captures = True 
+       captureString = "x" if captures else ""
        
        logging.debug( "Search for %s on square %s %s (captures %s %s)" % ( figure, dstString, dst, captures, figureDst ) )
        squares = self.moveFigureOnBoard( color, figure, dst, captures )
@@ -610,9 +821,8 @@ class Board( object ) :
            raise BoardException( "no figure found" )
        elif l == 1 and ( figure != "P" or not captures ):
            figure = figure if figure != "P" else ""
-           self.setSquare( src, " " )
-           self.setSquare( dst, coloredFigure )
-           return "%s%s%s" % ( figure, captureString, m[2:] )
+           self.applyAlgebraic( m, color, 0 )
+           return "%s%s%s%s" % ( figure, captureString, dstString, promotionString )
        else :
            figure = figure if figure != "P" else ""
            srcResultString = ""
@@ -620,17 +830,27 @@ class Board( object ) :
                srcResultString += str( unichr( ord( 'a' ) + src[ 0 ] - 1) )
            elif src[1 ] != dst[ 1 ] :
                srcResultString += str( unichr( ord( '1' ) + src[ 1 ] - 1 ) )
-           self.setSquare( src, " " )
-           self.setSquare( dst, coloredFigure )
-           return "%s%s%s%s" % ( figure, srcResultString, captureString, m[2:] )
+           self.applyAlgebraic( m, color, 0 )
+           return "%s%s%s%s%s" % ( figure, srcResultString, captureString, dstString, promotionString )
        
 
-   def transformListofAlgebraicMoveIntoPgn( self, moveListString, color ) :
+   def transformListofAlgebraicMoveIntoPgn( self, moveListString, color, sanCache = None ) :
        pgnMoves = ""
        moveList = moveListString.split()
+       h = self.positionHash( color ) if sanCache != None else None
        for m in moveList :
            logging.debug( "moveAlgebraic: %s" % ( m ) )
-           pgnMove = self.moveAlgebraic( m, color )
+           if sanCache != None :
+               key = ( h, m )
+               pgnMove = sanCache.get( key )
+               if pgnMove != None :
+                   h = self.applyAlgebraic( m, color, h )
+               else :
+                   pgnMove = self.moveAlgebraic( m, color )
+                   sanCache.put( key, pgnMove )
+                   h = self.positionHash( "b" if color == "w" else "w" )
+           else :
+               pgnMove = self.moveAlgebraic( m, color )
            # logging.debug( "movePgn: %s" % ( pgnMove ) )
            pgnMoves += " " + pgnMove
            logging.debug( "pgnMoves: %s" % ( pgnMoves ) )
@@ -669,18 +889,518 @@ class Move( object ) :
     def __init__( self, movenumber, whiteMove, blackMove ) :
         pass
 
+
+class SanCache( object ) :
+    """Bounded LRU cache ( position hash, algebraic move ) -> PGN move
+
+    Successive engine lines mostly share their first moves, so converting them into PGN
+    only has to search for source squares and disambiguations of the moves not seen before.
+    """
+    def __init__( self, maxSize = 100000 ) :
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get( self, key ) :
+        pgnMove = self.entries.pop( key, None )
+        if pgnMove == None :
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[ key ] = pgnMove
+        return pgnMove
+
+    def put( self, key, pgnMove ) :
+        self.entries[ key ] = pgnMove
+        if len( self.entries ) > self.maxSize :
+            self.entries.popitem( last = False )
+
+    def __len__( self ) :
+        return len( self.entries )
+
+##############################################################################################################    
+
+class CompactGame( object ) :
+    """A game with its moves packed into 16 bit codes, interned tags and out of line comments"""
+    __slots__ = ( "tags", "moves", "comments" )
+    # bits 0-5 source square, bits 6-11 destination square, bits 12-15 promotion figure + 5 * suffix
+    PROMOTION_FIGURES = " nbrq"
+    SUFFIXES = ( "", "+", "#" )
+    # check/mate suffix and move glyphs like '!?' of a PGN move
+    PGN_SUFFIX = re.compile( r'([+#]?)([!?]*)$' )
+    GLYPHS = ( "!", "?", "!!", "??", "!?", "?!" )
+
+    def __init__( self, tags = None, moves = None, comments = None ) :
+        self.tags = tags if tags != None else list()
+        self.moves = moves if moves != None else array( "H" )
+        # None or dict ply -> list of comments, most games have none
+        self.comments = comments
+
+    @staticmethod
+    def encodeMove( algebraicMove, suffix = "" ) :
+        src = ( ord( algebraicMove[ 1 ] ) - ord( '1' ) ) * 8 + ord( algebraicMove[ 0 ] ) - ord( 'a' )
+        dst = ( ord( algebraicMove[ 3 ] ) - ord( '1' ) ) * 8 + ord( algebraicMove[ 2 ] ) - ord( 'a' )
+        promotion = 0
+        if len( algebraicMove ) > 4 :
+            promotion = CompactGame.PROMOTION_FIGURES.index( algebraicMove[ 4 ].lower() )
+        return src | ( dst << 6 ) | ( ( promotion + 5 * CompactGame.SUFFIXES.index( suffix ) ) << 12 )
+
+    @staticmethod
+    def decodeSuffix( code ) :
+        return CompactGame.SUFFIXES[ ( code >> 12 ) // 5 ]
+
+    @staticmethod
+    def decodeMove( code ) :
+        src = code & 0x3f
+        dst = ( code >> 6 ) & 0x3f
+        promotion = ( code >> 12 ) % 5
+        s = "%s%s%s%s" % ( chr( ord( 'a' ) + ( src & 7 ) ), chr( ord( '1' ) + ( src >> 3 ) ),
+                           chr( ord( 'a' ) + ( dst & 7 ) ), chr( ord( '1' ) + ( dst >> 3 ) ) )
+        if promotion :
+            s += CompactGame.PROMOTION_FIGURES[ promotion ]
+        return s
+
+    @classmethod
+    def fromChessGame( cls, game ) :
+        compactGame = cls( [ intern( tag ) for tag in game.tags ] )
+        board = Board()
+        board.startPosition()
+        for ( ply, ( moveNumber, color, chessMove ) ) in enumerate( game.plies() ) :
+            algebraicMove = board.movePgn( chessMove.move, color )
+            ( suffix, glyph ) = cls.PGN_SUFFIX.search( chessMove.move ).groups()
+            compactGame.moves.append( cls.encodeMove( algebraicMove, suffix ) )
+            # a move glyph is stored as first comment, brace comments, variations and NAGs
+            # can not be mistaken for it
+            comments = ( [ glyph ] if glyph else [] ) + chessMove.comments
+            if comments :
+                if compactGame.comments == None :
+                    compactGame.comments = dict()
+                compactGame.comments[ ply ] = comments
+        return compactGame
+
+    def algebraicMoves( self ) :
+        return [ self.decodeMove( code ) for code in self.moves ]
+
+    def toChessGame( self ) :
+        game = ChessGame()
+        for tag in self.tags :
+            game.addTag( tag )
+        board = Board()
+        board.startPosition()
+        color = "w"
+        for ( ply, code ) in enumerate( self.moves ) :
+            pgnMove = board.moveAlgebraic( self.decodeMove( code ), color ) + self.decodeSuffix( code )
+            comments = self.comments.get( ply ) if self.comments else None
+            if comments and comments[ 0 ] in self.GLYPHS :
+                pgnMove += comments[ 0 ]
+                comments = comments[ 1: ]
+            moveNumber = str( ply // 2 + 1 )
+            if color == "w" :
+                game.addMove( moveNumber, pgnMove, None )
+                chessMove = game.lastMove.white
+            else :
+                game.addMove( moveNumber, None, pgnMove )
+                chessMove = game.lastMove.black
+            if comments :
+                chessMove.comments.extend( comments )
+            color = "b" if color == "w" else "w"
+        return game
+
+
+class CompactGameStore( object ) :
+    """Holds a large number of CompactGames and saves/loads them in a binary format
+
+    The file layout is column oriented, so loading is a few bulk array reads and no SAN has to
+    be parsed again:
+
+        magic, string count, game count, comment count
+        string lengths, string data          (tags and comments, utf-8)
+        tag offsets per game, tag string indices
+        move offsets per game, move codes
+        ( game, ply, string index ) per comment
+
+    All numbers are stored little endian.
+    """
+    MAGIC = b"CGS1"
+    HEADER = struct.Struct( "<4sIII" )
+
+    def __init__( self ) :
+        self.games = list()
+
+    def addGame( self, game ) :
+        compactGame = game if isinstance( game, CompactGame ) else CompactGame.fromChessGame( game )
+        self.games.append( compactGame )
+        return compactGame
+
+    def __len__( self ) :
+        return len( self.games )
+
+    def __getitem__( self, index ) :
+        return self.games[ index ]
+
+    @staticmethod
+    def writeArray( f, a ) :
+        if sys.byteorder == "big" :
+            a = array( a.typecode, a )
+            a.byteswap()
+        a.tofile( f )
+
+    @staticmethod
+    def readArray( f, typecode, count ) :
+        a = array( typecode )
+        if count :
+            a.fromfile( f, count )
+        if sys.byteorder == "big" :
+            a.byteswap()
+        return a
+
+    def save( self, filename ) :
+        strings = list()
+        stringIndex = dict()
+        def indexOf( s ) :
+            i = stringIndex.get( s )
+            if i == None :
+                i = stringIndex[ s ] = len( strings )
+                strings.append( s )
+            return i
+
+        tagOffsets = array( "I", [ 0 ] )
+        tagIndices = array( "I" )
+        moveOffsets = array( "I", [ 0 ] )
+        moves = array( "H" )
+        comments = array( "I" )
+        for ( gameIndex, game ) in enumerate( self.games ) :
+            for tag in game.tags :
+                tagIndices.append( indexOf( tag ) )
+            tagOffsets.append( len( tagIndices ) )
+            moves.extend( game.moves )
+            moveOffsets.append( len( moves ) )
+            if game.comments :
+                for ply in sorted( game.comments ) :
+                    for comment in game.comments[ ply ] :
+                        comments.extend( ( gameIndex, ply, indexOf( comment ) ) )
+
+        encodedStrings = [ s.encode( "utf-8" ) if not isinstance( s, bytes ) else s for s in strings ]
+        f = open( filename, "wb" )
+        f.write( self.HEADER.pack( self.MAGIC, len( strings ), len( self.games ), len( comments ) // 3 ) )
+        self.writeArray( f, array( "I", [ len( s ) for s in encodedStrings ] ) )
+        f.write( b"".join( encodedStrings ) )
+        for a in ( tagOffsets, tagIndices, moveOffsets, moves, comments ) :
+            self.writeArray( f, a )
+        f.close()
+
+    @classmethod
+    def load( cls, filename ) :
+        f = open( filename, "rb" )
+        ( magic, stringCount, gameCount, commentCount ) = cls.HEADER.unpack( f.read( cls.HEADER.size ) )
+        if magic != cls.MAGIC :
+            f.close()
+            raise IOError( "%s is not a compact game store" % filename )
+        stringLengths = cls.readArray( f, "I", stringCount )
+        data = f.read( sum( stringLengths ) )
+        strings = list()
+        pos = 0
+        for l in stringLengths :
+            s = data[ pos : pos + l ]
+            if not isinstance( s, str ) :
+                s = s.decode( "utf-8" )
+            strings.append( intern( s ) )
+            pos += l
+        tagOffsets = cls.readArray( f, "I", gameCount + 1 )
+        tagIndices = cls.readArray( f, "I", tagOffsets[ -1 ] )
+        moveOffsets = cls.readArray( f, "I", gameCount + 1 )
+        moves = cls.readArray( f, "H", moveOffsets[ -1 ] )
+        comments = cls.readArray( f, "I", commentCount * 3 )
+        f.close()
+
+        store = cls()
+        for i in xrange( gameCount ) :
+            tags = [ strings[ t ] for t in tagIndices[ tagOffsets[ i ] : tagOffsets[ i + 1 ] ] ]
+            store.games.append( CompactGame( tags, moves[ moveOffsets[ i ] : moveOffsets[ i + 1 ] ] ) )
+        for i in xrange( 0, len( comments ), 3 ) :
+            game = store.games[ comments[ i ] ]
+            if game.comments == None :
+                game.comments = dict()
+            game.comments.setdefault( int( comments[ i + 1 ] ), list() ).append( strings[ comments[ i + 2 ] ] )
+        return store
+
+##############################################################################################################    
+
+def gamePositionHashes( game ) :
+    # yields ( ply, position hash ) for the start position and the position after every ply
+    board = Board()
+    board.startPosition()
+    yield ( 0, board.positionHash( "w" ) )
+    if isinstance( game, CompactGame ) :
+        color = "w"
+        for ( ply, algebraicMove ) in enumerate( game.algebraicMoves() ) :
+            board.moveAlgebraic( algebraicMove, color )
+            color = "b" if color == "w" else "w"
+            yield ( ply + 1, board.positionHash( color ) )
+    else :
+        for ( ply, ( moveNumber, color, chessMove ) ) in enumerate( game.plies() ) :
+            board.movePgn( chessMove.move, color )
+            yield ( ply + 1, board.positionHash( "b" if color == "w" else "w" ) )
+
+
+class PositionIndex( object ) :
+    """Maps position hashes to ( game id, ply ) over a whole game collection
+
+    The index file is an array of ( hash, game id, ply ) records sorted by hash. It is memory
+    mapped and searched with bisection, the game id is the position of the game in the
+    collection the index was built from. Building sorts chunks of CHUNK_SIZE records and merges
+    the sorted runs from temporary files, so memory does not grow with the collection. Games with
+    an illegal move are left out of the index.
+    """
+    RECORD = struct.Struct( "<QII" )
+    CHUNK_SIZE = 1 << 20
+    WRITE_BATCH = 4096
+    # 64 bit hashes, python 2 arrays have no "Q"
+    HASH_TYPECODE = "L" if array( "L" ).itemsize == 8 else "Q"
+
+    def __init__( self, filename ) :
+        self.file = open( filename, "rb" )
+        self.file.seek( 0, 2 )
+        size = self.file.tell()
+        self.count = size // self.RECORD.size
+        self.data = mmap.mmap( self.file.fileno(), 0, access = mmap.ACCESS_READ ) if size else None
+
+    @classmethod
+    def build( cls, games, filename, chunkSize = CHUNK_SIZE, errors = None ) :
+        # games that can not be played on the board are logged and added to errors if given
+        hashes = array( cls.HASH_TYPECODE )
+        gameIds = array( "I" )
+        plies = array( "I" )
+        runs = list()
+        total = 0
+        try :
+            for ( gameId, game ) in enumerate( games ) :
+                try :
+                    positions = list( gamePositionHashes( game ) )
+                except BoardException as e :
+                    index = getattr( game, "index", None )
+                    index = index if index != None else gameId
+                    error = ParseError( index, getattr( game, "offset", None ), getattr( game, "line", None ),
+                                        "Illegal move: %s" % e, "" )
+                    if errors != None :
+                        errors.append( error )
+                    logging.warning( "not indexing game %s: %s" % ( index, error ) )
+                    continue
+                for ( ply, h ) in positions :
+                    hashes.append( h )
+                    gameIds.append( gameId )
+                    plies.append( ply )
+                if len( hashes ) >= chunkSize :
+                    runs.append( cls.writeRun( hashes, gameIds, plies, "%s.run%s" % ( filename, len( runs ) ) ) )
+                    total += len( hashes )
+                    hashes = array( cls.HASH_TYPECODE )
+                    gameIds = array( "I" )
+                    plies = array( "I" )
+            total += len( hashes )
+            if not runs :
+                cls.writeRun( hashes, gameIds, plies, filename )
+            else :
+                if hashes :
+                    runs.append( cls.writeRun( hashes, gameIds, plies, "%s.run%s" % ( filename, len( runs ) ) ) )
+                cls.mergeRuns( runs, filename )
+        finally :
+            # a run file is only listed once it is complete, the one being written may be left
+            for run in runs + [ "%s.run%s" % ( filename, len( runs ) ) ] :
+                if os.path.exists( run ) :
+                    os.remove( run )
+        logging.debug( "indexed %s positions into %s" % ( total, filename ) )
+        return cls( filename )
+
+    @classmethod
+    def writeRecords( cls, f, records ) :
+        batch = list()
+        pack = cls.RECORD.pack
+        for record in records :
+            batch.append( pack( *record ) )
+            if len( batch ) >= cls.WRITE_BATCH :
+                f.write( b"".join( batch ) )
+                batch = list()
+        f.write( b"".join( batch ) )
+
+    @classmethod
+    def writeRun( cls, hashes, gameIds, plies, filename ) :
+        # records arrive ordered by ( game id, ply ), a stable sort by hash keeps that order
+        order = sorted( xrange( len( hashes ) ), key = hashes.__getitem__ )
+        f = open( filename, "wb" )
+        cls.writeRecords( f, ( ( hashes[ i ], gameIds[ i ], plies[ i ] ) for i in order ) )
+        f.close()
+        return filename
+
+    @classmethod
+    def readRun( cls, filename ) :
+        size = cls.RECORD.size
+        f = open( filename, "rb" )
+        data = f.read( size * cls.WRITE_BATCH )
+        while data :
+            for offset in xrange( 0, len( data ), size ) :
+                yield cls.RECORD.unpack_from( data, offset )
+            data = f.read( size * cls.WRITE_BATCH )
+        f.close()
+
+    @classmethod
+    def mergeRuns( cls, runs, filename ) :
+        f = open( filename, "wb" )
+        cls.writeRecords( f, heapq.merge( *[ cls.readRun( run ) for run in runs ] ) )
+        f.close()
+
+    def close( self ) :
+        if self.data :
+            self.data.close()
+        self.file.close()
+
+    def __len__( self ) :
+        return self.count
+
+    def record( self, i ) :
+        return self.RECORD.unpack_from( self.data, i * self.RECORD.size )
+
+    def lookup( self, positionHash ) :
+        lo = 0
+        hi = self.count
+        while lo < hi :
+            mid = ( lo + hi ) // 2
+            if self.record( mid )[ 0 ] < positionHash :
+                lo = mid + 1
+            else :
+                hi = mid
+        result = list()
+        while lo < self.count :
+            ( h, gameId, ply ) = self.record( lo )
+            if h != positionHash :
+                break
+            result.append( ( gameId, ply ) )
+            lo += 1
+        return result
+
+    def findFen( self, fen ) :
+        board = Board()
+        board.readFen( fen )
+        fields = fen.split()
+        color = fields[ 1 ] if len( fields ) > 1 else "w"
+        return self.lookup( board.positionHash( color ) )
+
+    def findLine( self, pgnMoves ) :
+        # pgnMoves: PGN moves from the start position, e.g. "d4 d5 c4"; every game transposing
+        # into the resulting position is found no matter in which order it was reached
+        board = Board()
+        board.startPosition()
+        color = "w"
+        for m in pgnMoves.split() :
+            board.movePgn( m, color )
+            color = "b" if color == "w" else "w"
+        return self.lookup( board.positionHash( color ) )
+
+##############################################################################################################    
+
+class ScoreClassification( object ) :
+    """Per ply results of ScoreClassifier for a whole collection, concatenated game after game"""
+    def __init__( self, offsets, centipawnLoss, winProbabilityDelta, classification, acpl ) :
+        self.offsets = offsets
+        self.centipawnLoss = centipawnLoss
+        self.winProbabilityDelta = winProbabilityDelta
+        self.classification = classification
+        # shape ( games, 2 ): average centipawn loss of white and black
+        self.acpl = acpl
+
+    def gameSlice( self, gameIndex ) :
+        return slice( self.offsets[ gameIndex ], self.offsets[ gameIndex + 1 ] )
+
+
+class ScoreClassifier( object ) :
+    """Classifies the moves of many analyzed games in one vectorized pass over their scores
+
+    Scores are in pawns from white's point of view, one per ply, as stored in ChessMove.scoreCP.
+    Moves are classified by the score the moving side lost, so annotating a collection with
+    other thresholds needs no engine time.
+    """
+    NONE, INACCURACY, MISTAKE, BLUNDER = range( 4 )
+    CLASSIFICATION_NAMES = ( None, "inaccuracy", "mistake", "blunder" )
+    # $6 '?!', $2 '?' and $4 '??'
+    CLASSIFICATION_NAGS = ( None, 6, 2, 4 )
+    INACCURACY_THRESHOLD = 0.5
+    MISTAKE_THRESHOLD = 1.0
+    BLUNDER_THRESHOLD = 3.0
+    # scores beyond +/- 10 pawns are clipped, the win probability uses the lichess.org curve
+    MAX_SCORE = 10.0
+    WIN_PROBABILITY_SLOPE = 0.368208
+
+    def __init__( self, inaccuracy = INACCURACY_THRESHOLD, mistake = MISTAKE_THRESHOLD, blunder = BLUNDER_THRESHOLD, initialScore = 0.0 ) :
+        if numpy == None :
+            raise ImportError( "numpy is required for score classification" )
+        if not inaccuracy <= mistake <= blunder :
+            raise ValueError( "thresholds must not decrease from inaccuracy to blunder" )
+        self.thresholds = numpy.array( ( inaccuracy, mistake, blunder ), dtype = numpy.float64 )
+        self.initialScore = initialScore
+
+    def winProbability( self, scores ) :
+        return 1.0 / ( 1.0 + numpy.exp( -self.WIN_PROBABILITY_SLOPE * scores ) )
+
+    def classifyGames( self, games ) :
+        return self.classify( [ game.scores() for game in games ] )
+
+    def classifyAnalyses( self, gameAnalyses ) :
+        return self.classify( [ [ plyAnalysis.scoreCP for plyAnalysis in analysis ] for analysis in gameAnalyses ] )
+
+    def classify( self, scoreArrays ) :
+        lengths = numpy.array( [ len( a ) for a in scoreArrays ], dtype = numpy.int64 )
+        gameCount = len( lengths )
+        offsets = numpy.zeros( gameCount + 1, dtype = numpy.int64 )
+        numpy.cumsum( lengths, out = offsets[ 1: ] )
+        if offsets[ -1 ] :
+            scores = numpy.concatenate( [ numpy.asarray( a, dtype = numpy.float64 ) for a in scoreArrays ] )
+        else :
+            scores = numpy.zeros( 0, dtype = numpy.float64 )
+        scores = numpy.clip( scores, -self.MAX_SCORE, self.MAX_SCORE )
+
+        previous = numpy.empty_like( scores )
+        previous[ 1: ] = scores[ :-1 ]
+        previous[ offsets[ :-1 ][ lengths > 0 ] ] = self.initialScore
+
+        gameIndex = numpy.repeat( numpy.arange( gameCount ), lengths )
+        ply = numpy.arange( len( scores ) ) - offsets[ :-1 ][ gameIndex ]
+        black = ( ply & 1 ).astype( numpy.int64 )
+        sign = 1 - 2 * black
+
+        valid = numpy.isfinite( scores ) & numpy.isfinite( previous )
+        loss = numpy.where( valid, sign * ( previous - scores ), 0.0 )
+        centipawnLoss = numpy.maximum( loss, 0.0 ) * 100.0
+        winProbabilityDelta = numpy.where( valid, sign * ( self.winProbability( scores ) - self.winProbability( previous ) ), 0.0 )
+        classification = numpy.digitize( loss, self.thresholds ).astype( numpy.int8 )
+
+        bins = gameIndex * 2 + black
+        sums = numpy.bincount( bins, weights = centipawnLoss, minlength = 2 * gameCount )
+        counts = numpy.bincount( bins[ valid ], minlength = 2 * gameCount )
+        acpl = ( sums / numpy.maximum( counts, 1 ) ).reshape( ( gameCount, 2 ) )
+        return ScoreClassification( offsets, centipawnLoss, winProbabilityDelta, classification, acpl )
+
 ##############################################################################################################    
 
 class UCIEngine( object ) :
     # IGNORE_ANSWERS = [ "info currmove", "bestmove", "info depth", "info nodes" ]
     IGNORE_ANSWERS = []
-    INFO_REGEXP = re.compile( r'info.*score cp ([-]?[0-9]+) .*pv((?: [a-h][1-8][a-h][1-8])+)' )
-    def __init__( self, pathToExecutable, timePerMove = 3 ) : 
+    INFO_REGEXP = re.compile( r'info.*score (cp|mate) ([-]?[0-9]+)(?: .*pv((?: [a-h][1-8][a-h][1-8][qrbn]?)+))?' )
+    DEPTH_REGEXP = re.compile( r' depth ([0-9]+)' )
+    # a mate is scored like a 100 pawns advantage
+    MATE_SCORE = 100.0
+    def __init__( self, pathToExecutable, timePerMove = 3, readyTimeout = 5.0, maxRetries = 2, maxRestarts = 10 ) : 
        self.pathToExe = pathToExecutable
+       # seconds to wait for 'uciok', 'readyok' and 'bestmove' before the engine is considered hanging
+       self.readyTimeout = readyTimeout
+       # restarts for a single position, and in a row without a successful search in between
+       self.maxRetries = maxRetries
+       self.maxRestarts = maxRestarts
+       self.restarts = 0
        self.init()
        self.positionString = "position startpos moves"
        self.scoreCP = "0"
        self.pv = ""
+       self.depth = None
        self.timePerMove = timePerMove
 
     def scanMultiPVLine( self, data ) :
@@ -691,21 +1411,46 @@ class UCIEngine( object ) :
             # logging.debug( "scan info line: %s" % data )
             match = self.INFO_REGEXP.match( data )
             if match : 
-                self.scoreCP = float( match.group( 1 ) ) / 100.0
-                self.pv = match.group( 2 )
+                if match.group( 1 ) == "cp" :
+                    self.scoreCP = float( match.group( 2 ) ) / 100.0
+                else :
+                    # 'mate 0' means the side to move is mated
+                    mateIn = int( match.group( 2 ) )
+                    self.scoreCP = self.MATE_SCORE if mateIn > 0 else -self.MATE_SCORE
+                self.pv = match.group( 3 ) if match.group( 3 ) else ""
+                depthMatch = self.DEPTH_REGEXP.search( data )
+                self.depth = int( depthMatch.group( 1 ) ) if depthMatch else None
                 logging.debug( "score cp: %s pv: %s " % ( self.scoreCP, self.pv )  )
             return
         
         pass
         # we are only interested in "info .* .* score cp .* pv"
 
-    def readUCIOutput( self ) :
+    def readLine( self, timeout ) :
+        # next line of engine output, "" when the engine closed its output and None when no
+        # complete line arrives within timeout seconds: the pipe is read without blocking, so
+        # an engine hanging in the middle of a line can not hang us too
+        deadline = time() + timeout
+        fileDescriptor = self.enginePipe.stdout.fileno()
         poll = select.poll()
-        poll.register( self.enginePipe.stdout.fileno(), select.POLLIN )
-        fileDescriptorList = poll.poll( 100 )
-        data = None
-        while len( fileDescriptorList ) > 0 and ( fileDescriptorList[ 0 ][ 1 ] &  select.POLLIN ) : 
-            data = self.enginePipe.stdout.readline()
+        poll.register( fileDescriptor, select.POLLIN | select.POLLHUP )
+        while "\n" not in self.outputBuffer :
+            remaining = deadline - time()
+            if remaining <= 0 or not poll.poll( remaining * 1000 ) :
+                return None
+            data = os.read( fileDescriptor, 4096 )
+            if not data :
+                return ""
+            self.outputBuffer += data
+        ( line, self.outputBuffer ) = self.outputBuffer.split( "\n", 1 )
+        return line + "\n"
+
+    def readUCIOutput( self ) :
+        # everything the engine sends until it is silent for 0.1 seconds
+        lastData = None
+        data = self.readLine( 0.1 )
+        while data :
+            lastData = data
             printAnswer = True
             for ignorePrefix in self.IGNORE_ANSWERS : 
                 if data.find( ignorePrefix ) != -1 :
@@ -714,92 +1459,800 @@ class UCIEngine( object ) :
             if printAnswer :
                 self.filterUCIOutput( data )
                 # logging.debug( data, end = "" )
-            fileDescriptorList = poll.poll( 100 )
-        return data
+            data = self.readLine( 0.1 )
+        return lastData
             
+    def readUntil( self, prefix, timeout ) :
+        # read engine output until a line starting with prefix, False on timeout or a dead engine
+        deadline = time() + timeout
+        while True :
+            data = self.readLine( max( deadline - time(), 0 ) )
+            if data == None :
+                logging.warning( "engine did not answer %s within %s seconds" % ( prefix, timeout ) )
+                return False
+            if not data :
+                logging.warning( "engine closed its output, exit status %s" % self.enginePipe.poll() )
+                return False
+            self.filterUCIOutput( data )
+            if data.startswith( prefix ) :
+                return True
+
     def init( self ) :
         self.enginePipe = Popen( [ self.pathToExe ], stdout = PIPE, stdin = PIPE )
-        sleep( 0.1 )
-        print( "uci", file = self.enginePipe.stdin )
+        # output read but not yet split into lines, see readLine
+        self.outputBuffer = ""
+        try :
+            print( "uci", file = self.enginePipe.stdin )
+        except IOError :
+            pass
+        if not self.readUntil( "uciok", self.readyTimeout ) :
+            self.stopProcess()
+            raise EngineException( "Engine %s did not start" % self.pathToExe )
+
+    def isAlive( self ) :
+        return self.enginePipe.poll() == None
+
+    def isReady( self ) :
+        try :
+            print( "isready", file = self.enginePipe.stdin )
+        except IOError :
+            return False
+        return self.readUntil( "readyok", self.readyTimeout )
+
+    def stopProcess( self ) :
+        if self.isAlive() :
+            self.enginePipe.terminate()
+            deadline = time() + 1.0
+            while self.isAlive() and time() < deadline :
+                sleep( 0.05 )
+            if self.isAlive() :
+                self.enginePipe.kill()
+        self.enginePipe.wait()
+
+    def restart( self ) :
+        if self.restarts >= self.maxRestarts :
+            raise EngineException( "Engine %s failed, giving up after %s restarts in a row" % ( self.pathToExe, self.restarts ) )
+        self.restarts += 1
+        logging.warning( "restarting engine %s (restart %s of %s)" % ( self.pathToExe, self.restarts, self.maxRestarts ) )
+        self.stopProcess()
+        self.init()
+
+    def newGame( self ) :
+        self.positionString = "position startpos moves"
+        try :
+            print( "ucinewgame", file = self.enginePipe.stdin )
+        except IOError :
+            self.restart()
+            return
         self.readUCIOutput()
 
     def finish( self ) :
-        print( "quit", file = self.enginePipe.stdin )
-        self.enginePipe.terminate()
-        self.enginePipe.wait()
+        try :
+            print( "quit", file = self.enginePipe.stdin )
+        except IOError :
+            pass
+        self.stopProcess()
         
     def nextMove( self, m ) :
         self.positionString = self.positionString + " " + m
+        self.analyzeCurrentPosition()
+
+    def analyzePosition( self, algebraicMoves ) :
+        self.positionString = " ".join( [ "position startpos moves" ] + list( algebraicMoves ) )
+        self.analyzeCurrentPosition()
+
+    def analyzeCurrentPosition( self ) :
+        # a dead or hanging engine is restarted and the position analyzed again, so a result
+        # never silently carries the score and pv of the previous position
+        for attempt in xrange( self.maxRetries + 1 ) :
+            try :
+                if attempt > 0 :
+                    self.restart()
+                if self.searchCurrentPosition() :
+                    self.restarts = 0
+                    return
+            except IOError as e :
+                logging.warning( "lost engine connection: %s" % e )
+            except EngineException as e :
+                # an engine failing to come up again counts as a failed attempt, unless
+                # the restart budget is used up
+                if self.restarts >= self.maxRestarts :
+                    raise
+                logging.warning( str( e ) )
+        raise EngineException( "Engine %s failed %s times on %s" % ( self.pathToExe, self.maxRetries + 1, self.positionString ) )
+
+    def searchCurrentPosition( self ) :
         logging.debug( self.positionString )
+        self.scoreCP = None
+        self.pv = None
+        self.depth = None
         print( self.positionString, file = self.enginePipe.stdin )
-        self.readUCIOutput()
+        if not self.isReady() :
+            return False
         print( "go infinite", file = self.enginePipe.stdin )
         sleep( self.timePerMove )
         self.readUCIOutput()
         print( "stop", file = self.enginePipe.stdin )
-        sleep( 0.1 )
-        self.readUCIOutput()
-
-
-    def analyzeGame( self, game, timePerMove = 3, annotateWhite = True, annotateBlack = True, scoreThreshold = 1.1 ) :
+        if not self.readUntil( "bestmove", self.readyTimeout ) :
+            return False
+        if self.scoreCP == None :
+            logging.warning( "engine sent no score for %s" % self.positionString )
+            return False
+        return True
+
+
+    def analyzePly( self, ply, moveNumber, color, move, algebraicMove, stored ) :
+        # plies found in stored are only added to the position, not searched again
+        if ply < len( stored ) :
+            self.positionString = self.positionString + " " + algebraicMove
+            return stored[ ply ]
+        self.nextMove( algebraicMove )
+        scoreCP = -self.scoreCP if color == "w" else self.scoreCP
+        return PlyAnalysis( ply, moveNumber, color, move, algebraicMove, scoreCP, self.pv, self.depth )
+
+    def analyzePlies( self, game, maxMovesCounter = 300, stored = () ) :
+        self.newGame()
         board = Board()
         board.startPosition()
         blackMissing = False
-        maxMovesCounter = 300 # limit moves for test purposes
         moveCounter = 0
-        pgnVariation = None
-        previousScoreCP = 0.0
-        
+        ply = 0
+
         for move in game.moves :
             if blackMissing :
-                raise BoardException( "White moves at %s after black has not moved", move.moveNumber )
+                raise BoardException( "White moves at %s after black has not moved" % move.moveNumber )
             algebraicMove = board.movePgn( move.white.move, "w" )
-            self.nextMove( algebraicMove )
-            variationBoard = Board( board )
-            scoreCP = -self.scoreCP
-            move.white.scoreCP = scoreCP
-            if annotateWhite and scoreCP - previousScoreCP < -scoreThreshold :
-                logging.debug( "score cp difference %s" %  ( scoreCP - previousScoreCP ) )
-                move.white.variation = pgnVariation
-            previousScoreCP = scoreCP
-            pgnVariation = variationBoard.transformListofAlgebraicMoveIntoPgn( self.pv, "b" )
-            pgnVariation = variationBoard.formatVariation( pgnVariation, move.moveNumber, "b" )
-            logging.debug( "variation: %s" % pgnVariation )
-            
+            yield self.analyzePly( ply, move.moveNumber, "w", move.white.move, algebraicMove, stored )
+            ply += 1
+
             if move.black : 
                 algebraicMove = board.movePgn( move.black.move, "b" )
-                self.nextMove( algebraicMove )
-                variationBoard = Board( board )
-                scoreCP = self.scoreCP
-                move.black.scoreCP = scoreCP
-                if annotateBlack and scoreCP - previousScoreCP > scoreThreshold :
-                    logging.debug( "score cp difference %s" %  ( scoreCP - previousScoreCP ) )
-                    move.black.variation = pgnVariation
-                previousScoreCP = scoreCP
-                pgnVariation = variationBoard.transformListofAlgebraicMoveIntoPgn( self.pv, "w" )
-                pgnVariation = variationBoard.formatVariation( pgnVariation, move.moveNumber, "w" )
-                logging.debug( "variation: %s" % pgnVariation )
+                yield self.analyzePly( ply, move.moveNumber, "b", move.black.move, algebraicMove, stored )
+                ply += 1
             else :
                 blackMissing = True
             moveCounter += 1
             if moveCounter >= maxMovesCounter :
                 break
-        board.logPrint()
 
-def testUCIEngine( game, options ) :
-    engine = UCIEngine( options.enginePath, options.timePerMove )
-    engine.analyzeGame( game, options.timePerMove, options.annotateWhite, options.annotateBlack, options.scoreThreshold )
-    if options.outputFile :
-        of = open( options.outputFile, "w" )
+    def analyzeGame( self, game, timePerMove = 3, annotateWhite = True, annotateBlack = True, scoreThreshold = 1.1, variationForBadMove = False, analysisFile = None, maxMoves = 300,
+                     classifier = None ) :
+        if not analysisFile :
+            analysis = list( self.analyzePlies( game, maxMoves ) )
+        else :
+            # every ply is written as soon as it is analyzed, a rerun continues after the plies
+            # already stored for this game
+            stored = list()
+            if os.path.exists( analysisFile ) :
+                gameAnalyses = loadAnalysis( analysisFile )
+                for ( plyAnalysis, ( moveNumber, color, chessMove ) ) in zip( gameAnalyses[ 0 ] if gameAnalyses else (), game.plies() ) :
+                    if plyAnalysis.move != chessMove.move :
+                        break
+                    stored.append( plyAnalysis )
+                logging.info( "%s plies already analyzed in %s" % ( len( stored ), analysisFile ) )
+            analysis = list()
+            f = open( analysisFile, "w" )
+            for plyAnalysis in self.analyzePlies( game, maxMoves, stored ) :
+                writeAnalysis( f, 0, plyAnalysis )
+                f.flush()
+                analysis.append( plyAnalysis )
+            f.close()
+        classification = classifier.classifyAnalyses( [ analysis ] ).classification.tolist() if classifier != None else None
+        annotateGame( game, analysis, annotateWhite, annotateBlack, scoreThreshold, variationForBadMove, classification = classification )
+        return analysis
+
+##############################################################################################################    
+
+class PlyAnalysis( object ) :
+    """Raw engine result for one ply, scoreCP in pawns from white's point of view and
+    pv the engine's line in algebraic notation from the position after the ply"""
+    FIELDS = ( "ply", "moveNumber", "color", "move", "algebraicMove", "scoreCP", "pv", "depth" )
+
+    def __init__( self, ply, moveNumber, color, move, algebraicMove, scoreCP, pv, depth ) :
+        self.ply = ply
+        self.moveNumber = moveNumber
+        self.color = color
+        self.move = move
+        self.algebraicMove = algebraicMove
+        self.scoreCP = scoreCP
+        self.pv = pv
+        self.depth = depth
+
+    def toDict( self ) :
+        return dict( ( field, getattr( self, field ) ) for field in self.FIELDS )
+
+    @classmethod
+    def fromDict( cls, d ) :
+        return cls( *[ d.get( field ) for field in cls.FIELDS ] )
+
+
+def writeAnalysis( f, gameIndex, plyAnalysis ) :
+    # one JSON object per line and ply, "game" is the index of the game in the input file
+    d = plyAnalysis.toDict()
+    d[ "game" ] = gameIndex
+    f.write( json.dumps( d, sort_keys = True ) + "\n" )
+
+def saveAnalysis( gameAnalyses, filename ) :
+    f = open( filename, "w" )
+    for ( gameIndex, analysis ) in enumerate( gameAnalyses ) :
+        for plyAnalysis in analysis :
+            writeAnalysis( f, gameIndex, plyAnalysis )
+    f.close()
+
+def loadAnalysis( filename ) :
+    gameAnalyses = list()
+    f = open( filename, "r" )
+    for line in f :
+        if not line.strip() :
+            continue
+        d = json.loads( line )
+        gameIndex = d[ "game" ]
+        while len( gameAnalyses ) <= gameIndex :
+            gameAnalyses.append( list() )
+        gameAnalyses[ gameIndex ].append( PlyAnalysis.fromDict( d ) )
+    f.close()
+    return gameAnalyses
+
+PV_SAN_CACHE = SanCache()
+
+def formatPvVariation( board, pv, moveNumber, color, sanCache = PV_SAN_CACHE ) :
+    # board is the position after the ply with move number moveNumber, color the side to move
+    variationBoard = Board( board )
+    pgnVariation = variationBoard.transformListofAlgebraicMoveIntoPgn( pv, color, sanCache )
+    pgnVariation = variationBoard.formatVariation( pgnVariation, moveNumber, color )
+    logging.debug( "variation: %s" % pgnVariation )
+    return pgnVariation
+
+def annotateGame( game, analysis, annotateWhite = True, annotateBlack = True, scoreThreshold = 1.1, variationForBadMove = False, sanCache = PV_SAN_CACHE,
+                  classification = None ) :
+    # no engine needed, variations are only replayed for the plies that get annotated. With the
+    # per ply classification of a ScoreClassifier the classified moves are annotated with their
+    # NAG, scoreThreshold is not used then
+    board = Board()
+    board.startPosition()
+    previousBoard = None
+    previous = None
+    previousScoreCP = 0.0
+
+    for ( ply, ( ( moveNumber, color, chessMove ), plyAnalysis ) ) in enumerate( zip( game.plies(), analysis ) ) :
+        if plyAnalysis.move != chessMove.move :
+            raise BoardException( "Analysis of ply %s is for %s, game has %s" % ( plyAnalysis.ply, plyAnalysis.move, chessMove.move ) )
+        boardBefore = Board( board )
+        board.movePgn( chessMove.move, color )
+        otherColor = "b" if color == "w" else "w"
+        scoreCP = plyAnalysis.scoreCP
+        chessMove.scoreCP = scoreCP
+        chessMove.nag = None
+        chessMove.variation = None
+        chessMove.refutation = None
+        if classification != None :
+            badMove = ( annotateWhite if color == "w" else annotateBlack ) and classification[ ply ] != ScoreClassifier.NONE
+            if badMove :
+                chessMove.nag = ScoreClassifier.CLASSIFICATION_NAGS[ classification[ ply ] ]
+        elif color == "w" :
+            badMove = annotateWhite and scoreCP - previousScoreCP < -scoreThreshold
+        else :
+            badMove = annotateBlack and scoreCP - previousScoreCP > scoreThreshold
+        if badMove :
+            logging.debug( "score cp difference %s" %  ( scoreCP - previousScoreCP ) )
+            if previous :
+                chessMove.variation = formatPvVariation( boardBefore, previous.pv, previous.moveNumber, color, sanCache )
+            if variationForBadMove :
+                chessMove.refutation = formatPvVariation( board, plyAnalysis.pv, moveNumber, otherColor, sanCache )
+        previousScoreCP = scoreCP
+        previous = plyAnalysis
+    board.logPrint()
+
+def writeGames( games, outputFile ) :
+    if outputFile :
+        of = open( outputFile, "w" )
     else :
         of = sys.stdout
         
-    game.stream( of )
-    if options.outputFile :
+    for ( i, game ) in enumerate( games ) :
+        if i > 0 :
+            print( "", file = of )
+        game.stream( of )
+    if outputFile :
         of.close()
-        
+
+def writeGame( game, outputFile ) :
+    writeGames( [ game ], outputFile )
+
+##############################################################################################################    
+
+class BatchAnalyzer( object ) :
+    """Analyzes a collection of games with every distinct position sent to the engine only once
+
+    All games are replayed first and their positions collapsed into a DAG keyed by position hash
+    including castling rights and 'en passant', so
+    duplicate games and shared openings cost engine time once. Every position links to the
+    position and move it was first reached from, the move path sent to the engine is rebuilt
+    from these links. The results are then fanned out into a PlyAnalysis list per game, the
+    same as UCIEngine.analyzePlies would have produced.
+    """
+    def __init__( self, engine, maxMoves = 300 ) :
+        self.engine = engine
+        self.maxMoves = maxMoves
+        board = Board()
+        board.startPosition()
+        self.startPosition = board.positionKey( "w", "KQkq", 0 )
+        # position key -> ( parent position key, algebraic move ), None for the start position
+        self.positions = OrderedDict()
+        self.positions[ self.startPosition ] = None
+        self.startPositionReached = False
+        # per game a list of ( position key, ply, moveNumber, color, move, algebraicMove ),
+        # empty for games that can not be played on the board
+        self.gamePlies = list()
+        self.results = dict()
+        self.errors = list()
+
+    def plan( self, games ) :
+        for ( gameIndex, game ) in enumerate( games ) :
+            board = Board()
+            board.startPosition()
+            parent = self.startPosition
+            castlingRights = "KQkq"
+            plies = list()
+            try :
+                for ( ply, ( moveNumber, color, chessMove ) ) in enumerate( game.plies() ) :
+                    if ply >= 2 * self.maxMoves :
+                        break
+                    algebraicMove = board.movePgn( chessMove.move, color )
+                    castlingRights = board.updateCastlingRights( castlingRights, algebraicMove )
+                    h = board.positionKey( "b" if color == "w" else "w", castlingRights, board.enPassantFile( algebraicMove ) )
+                    plies.append( ( h, ply, moveNumber, color, chessMove.move, algebraicMove ) )
+            except BoardException as e :
+                index = game.index if game.index != None else gameIndex
+                self.errors.append( ParseError( index, game.offset, game.line,
+                                                "Illegal move %s%s: %s" % ( moveNumber, "." if color == "w" else "...", e ),
+                                                chessMove.move ) )
+                logging.warning( "skipping game %s: %s" % ( index, self.errors[ -1 ] ) )
+                self.gamePlies.append( list() )
+                continue
+            for ( h, ply, moveNumber, color, move, algebraicMove ) in plies :
+                if h not in self.positions :
+                    self.positions[ h ] = ( parent, algebraicMove )
+                elif h == self.startPosition :
+                    self.startPositionReached = True
+                parent = h
+            self.gamePlies.append( plies )
+        totalPlies = sum( len( plies ) for plies in self.gamePlies )
+        logging.info( "%s plies in %s games, %s distinct positions to analyze" % ( totalPlies, len( self.gamePlies ), len( self.positions ) ) )
+
+    def path( self, h ) :
+        # algebraic moves from the start position, following the links back to it
+        path = list()
+        link = self.positions[ h ]
+        while link != None :
+            ( h, algebraicMove ) = link
+            path.append( algebraicMove )
+            link = self.positions[ h ]
+        path.reverse()
+        return path
+
+    def loadResults( self, filename ) :
+        # results of an earlier, possibly interrupted run, see analyze
+        f = open( filename, "r" )
+        for line in f :
+            if not line.strip() :
+                continue
+            d = json.loads( line )
+            self.results[ d[ "key" ] ] = ( d[ "scoreCP" ], d[ "pv" ], d[ "depth" ] )
+        f.close()
+        logging.info( "%s analyzed positions loaded from %s" % ( len( self.results ), filename ) )
+
+    def analyze( self, resultsFile = None ) :
+        # every result is appended to resultsFile as soon as the engine is done with the position
+        f = open( resultsFile, "a" ) if resultsFile else None
+        self.engine.newGame()
+        for h in self.positions :
+            if h in self.results or ( h == self.startPosition and not self.startPositionReached ) :
+                continue
+            self.engine.analyzePosition( self.path( h ) )
+            # score of the side to move
+            self.results[ h ] = ( self.engine.scoreCP, self.engine.pv, self.engine.depth )
+            if f :
+                f.write( json.dumps( { "key" : h, "scoreCP" : self.engine.scoreCP, "pv" : self.engine.pv, "depth" : self.engine.depth },
+                                     sort_keys = True ) + "\n" )
+                f.flush()
+        if f :
+            f.close()
+
+    def gameAnalyses( self ) :
+        gameAnalyses = list()
+        for plies in self.gamePlies :
+            analysis = list()
+            for ( h, ply, moveNumber, color, move, algebraicMove ) in plies :
+                ( scoreCP, pv, depth ) = self.results[ h ]
+                if color == "w" :
+                    scoreCP = -scoreCP
+                analysis.append( PlyAnalysis( ply, moveNumber, color, move, algebraicMove, scoreCP, pv, depth ) )
+            gameAnalyses.append( analysis )
+        return gameAnalyses
+
+##############################################################################################################    
+
+class ColumnarExporter( object ) :
+    """Writes tags and per ply moves, scores and classifications of games in columnar form
+
+    Games are buffered until rowGroupSize ply and tag rows are collected, then classified in one pass and
+    written as a row group, so memory stays bounded however many games are exported. With
+    pyarrow the plies go to <basename>.parquet and the tags to <basename>.tags.parquet, without
+    it every row group is written to <basename>-NNNNN.npz holding ply and tag columns.
+    """
+    ROW_GROUP_SIZE = 65536
+    PLY_COLUMNS = ( "game", "ply", "moveNumber", "color", "move", "score", "centipawnLoss", "classification" )
+    TAG_COLUMNS = ( "game", "name", "value" )
+    # pyarrow types of the columns above, explicit so every row group gets the same schema
+    PLY_ARROW_TYPES = ( "uint32", "uint16", "uint16", "int8", "string", "float32", "float32", "int8" )
+    TAG_ARROW_TYPES = ( "uint32", "string", "string" )
+
+    def __init__( self, basename, rowGroupSize = ROW_GROUP_SIZE, classifier = None, useArrow = True ) :
+        if numpy == None :
+            raise ImportError( "numpy is required for the columnar export" )
+        self.basename = basename
+        self.rowGroupSize = rowGroupSize
+        self.classifier = classifier if classifier != None else ScoreClassifier()
+        self.useArrow = useArrow and pyarrow != None
+        self.gameCount = 0
+        self.rowGroupCount = 0
+        self.plyWriter = None
+        self.tagWriter = None
+        self.clear()
+
+    def clear( self ) :
+        self.scoreArrays = list()
+        self.plies = dict( ( column, list() ) for column in self.PLY_COLUMNS[ :5 ] )
+        self.tags = dict( ( column, list() ) for column in self.TAG_COLUMNS )
+        self.bufferedRows = 0
+
+    def addGame( self, game ) :
+        gameId = self.gameCount
+        self.gameCount += 1
+        for ( name, value ) in game.tagPairs() :
+            self.bufferedRows += 1
+            self.tags[ "game" ].append( gameId )
+            self.tags[ "name" ].append( name )
+            self.tags[ "value" ].append( value )
+        for ( ply, ( moveNumber, color, chessMove ) ) in enumerate( game.plies() ) :
+            self.plies[ "game" ].append( gameId )
+            self.plies[ "ply" ].append( ply )
+            self.plies[ "moveNumber" ].append( int( moveNumber ) )
+            self.plies[ "color" ].append( 0 if color == "w" else 1 )
+            self.plies[ "move" ].append( chessMove.move )
+        scores = game.scores()
+        self.scoreArrays.append( scores )
+        self.bufferedRows += len( scores )
+        if self.bufferedRows >= self.rowGroupSize :
+            self.flush()
+
+    def flush( self ) :
+        if not self.scoreArrays :
+            return
+        classification = self.classifier.classify( self.scoreArrays )
+        plies = {
+            "game" : numpy.array( self.plies[ "game" ], dtype = numpy.uint32 ),
+            "ply" : numpy.array( self.plies[ "ply" ], dtype = numpy.uint16 ),
+            "moveNumber" : numpy.array( self.plies[ "moveNumber" ], dtype = numpy.uint16 ),
+            "color" : numpy.array( self.plies[ "color" ], dtype = numpy.int8 ),
+            "move" : self.plies[ "move" ],
+            "score" : numpy.concatenate( [ numpy.asarray( a, dtype = numpy.float32 ) for a in self.scoreArrays ] ),
+            "centipawnLoss" : classification.centipawnLoss.astype( numpy.float32 ),
+            "classification" : classification.classification,
+        }
+        tags = {
+            "game" : numpy.array( self.tags[ "game" ], dtype = numpy.uint32 ),
+            "name" : self.tags[ "name" ],
+            "value" : self.tags[ "value" ],
+        }
+        if self.useArrow :
+            self.writeArrow( plies, tags )
+        else :
+            self.writeNumpy( plies, tags )
+        self.rowGroupCount += 1
+        self.clear()
+
+    def writeArrow( self, plies, tags ) :
+        plyTable = self.arrowTable( plies, self.PLY_COLUMNS, self.PLY_ARROW_TYPES )
+        tagTable = self.arrowTable( tags, self.TAG_COLUMNS, self.TAG_ARROW_TYPES )
+        if self.plyWriter == None :
+            self.plyWriter = pyarrow.parquet.ParquetWriter( self.basename + ".parquet", plyTable.schema )
+            self.tagWriter = pyarrow.parquet.ParquetWriter( self.basename + ".tags.parquet", tagTable.schema )
+        self.plyWriter.write_table( plyTable )
+        self.tagWriter.write_table( tagTable )
+
+    def arrowTable( self, columns, names, types ) :
+        arrowTypes = [ getattr( pyarrow, t )() for t in types ]
+        schema = pyarrow.schema( [ pyarrow.field( name, arrowType ) for ( name, arrowType ) in zip( names, arrowTypes ) ] )
+        return pyarrow.Table.from_arrays( [ pyarrow.array( columns[ name ], type = arrowType ) for ( name, arrowType ) in zip( names, arrowTypes ) ],
+                                          schema = schema )
+
+    def writeNumpy( self, plies, tags ) :
+        columns = dict( plies )
+        columns[ "move" ] = numpy.array( plies[ "move" ] )
+        columns[ "tagGame" ] = tags[ "game" ]
+        columns[ "tagName" ] = numpy.array( tags[ "name" ] )
+        columns[ "tagValue" ] = numpy.array( tags[ "value" ] )
+        numpy.savez( "%s-%05d.npz" % ( self.basename, self.rowGroupCount ), **columns )
+
+    def close( self ) :
+        self.flush()
+        if self.plyWriter != None :
+            self.plyWriter.close()
+            self.tagWriter.close()
+
+def exportColumnar( games, basename, classifier = None ) :
+    exporter = ColumnarExporter( basename, classifier = classifier )
+    for game in games :
+        exporter.addGame( game )
+    exporter.close()
+
+##############################################################################################################    
+
+class AnalysisJob( object ) :
+    """A game queued for analysis, results are passed to the client through a queue,
+    one PlyAnalysis dict per ply, then the annotated game and finally None"""
+    def __init__( self, game, priority = 0, timePerMove = 3.0, budget = None, annotateWhite = True,
+                  annotateBlack = True, scoreThreshold = 1.1, variationForBadMove = False ) :
+        self.game = game
+        self.priority = priority
+        self.timePerMove = timePerMove
+        self.budget = budget
+        self.annotateWhite = annotateWhite
+        self.annotateBlack = annotateBlack
+        self.scoreThreshold = scoreThreshold
+        self.variationForBadMove = variationForBadMove
+        self.results = Queue()
+        self.cancelled = False
+
+
+class AnalysisWorker( threading.Thread ) :
+    """Owns one warm engine and works off jobs from the server's priority queue"""
+    def __init__( self, engine, jobs ) :
+        threading.Thread.__init__( self )
+        self.daemon = True
+        self.engine = engine
+        self.jobs = jobs
+        # SanCache is not thread safe, every worker has its own
+        self.sanCache = SanCache()
+
+    def run( self ) :
+        while True :
+            ( priority, sequence, job ) = self.jobs.get()
+            if job == None :
+                break
+            try :
+                self.analyze( job )
+            except EngineException as e :
+                logging.error( "analysis job failed: %s" % e )
+                job.results.put( { "error" : str( e ) } )
+                self.recover()
+            except Exception as e :
+                logging.exception( "analysis job failed" )
+                job.results.put( { "error" : str( e ) } )
+            job.results.put( None )
+
+    def recover( self ) :
+        # the restart budget is per job, the next job gets a fresh engine and a full budget
+        # even when this restart fails
+        self.engine.restarts = 0
+        try :
+            self.engine.restart()
+        except EngineException as e :
+            logging.error( "engine restart failed: %s" % e )
+        self.engine.restarts = 0
+
+    def analyze( self, job ) :
+        self.engine.timePerMove = job.timePerMove
+        startTime = time()
+        analysis = list()
+        complete = True
+        for plyAnalysis in self.engine.analyzePlies( job.game ) :
+            analysis.append( plyAnalysis )
+            job.results.put( plyAnalysis.toDict() )
+            if job.cancelled :
+                return
+            if job.budget != None and time() - startTime > job.budget :
+                complete = False
+                break
+        annotateGame( job.game, analysis, job.annotateWhite, job.annotateBlack, job.scoreThreshold,
+                      job.variationForBadMove, self.sanCache )
+        out = StringIO()
+        job.game.stream( out )
+        job.results.put( { "pgn" : out.getvalue(), "complete" : complete } )
+
+
+class AnalysisRequestHandler( BaseHTTPRequestHandler ) :
+    # POST /analyze?priority=0&timePerMove=3&budget=60&threshold=1.1&white=1&black=1&variationForBadMove=0
+    # with the PGN as body, answers one JSON object per line as soon as every ply is analyzed
+    MAX_CONTENT_LENGTH = 1 << 20
+
+    def address_string( self ) :
+        if isinstance( self.client_address, tuple ) :
+            return self.client_address[ 0 ]
+        return "unix"
+
+    def log_message( self, format, *args ) :
+        logging.debug( "%s %s" % ( self.address_string(), format % args ) )
+
+    def sendJson( self, code, d ) :
+        body = json.dumps( d ) + "\n"
+        self.send_response( code )
+        self.send_header( "Content-Type", "application/json" )
+        self.send_header( "Content-Length", str( len( body ) ) )
+        self.end_headers()
+        self.wfile.write( body.encode( "utf-8" ) )
+
+    def do_GET( self ) :
+        if urlparse( self.path ).path != "/status" :
+            self.sendJson( 404, { "error" : "unknown path" } )
+            return
+        server = self.server.analysisServer
+        self.sendJson( 200, { "queued" : server.jobs.qsize(), "engines" : len( server.workers ),
+                              "enginesRunning" : sum( 1 for worker in server.workers if worker.engine.isAlive() ) } )
+
+    def do_POST( self ) :
+        url = urlparse( self.path )
+        if url.path != "/analyze" :
+            self.sendJson( 404, { "error" : "unknown path" } )
+            return
+        server = self.server.analysisServer
+        query = dict( ( k, v[ -1 ] ) for ( k, v ) in parse_qs( url.query ).items() )
+        try :
+            length = int( self.headers.get( "Content-Length", 0 ) )
+            if length < 0 or length > self.MAX_CONTENT_LENGTH :
+                raise ValueError( "Content-Length must be between 0 and %s" % self.MAX_CONTENT_LENGTH )
+            text = self.rfile.read( length )
+            parser = PgnParser( Scanner( text = text ) )
+            game = parser.completeGame()
+            if not parser.scanner.atEnd() :
+                raise SyntaxError( parser.scanner.scanPosition, "Only one game per request" )
+            if not game.moves :
+                raise SyntaxError( parser.scanner.scanPosition, "Game has no moves" )
+            self.checkMoves( game )
+            job = AnalysisJob( game,
+                               priority = int( query.get( "priority", 0 ) ),
+                               timePerMove = float( query.get( "timePerMove", server.timePerMove ) ),
+                               budget = float( query[ "budget" ] ) if "budget" in query else None,
+                               annotateWhite = query.get( "white", "1" ) != "0",
+                               annotateBlack = query.get( "black", "1" ) != "0",
+                               scoreThreshold = float( query.get( "threshold", 1.1 ) ),
+                               variationForBadMove = query.get( "variationForBadMove", "0" ) != "0" )
+        except ( SyntaxError, ValueError ) as e :
+            self.sendJson( 400, { "error" : str( e ) } )
+            return
+        server.submit( job )
+
+        self.send_response( 200 )
+        self.send_header( "Content-Type", "application/x-ndjson" )
+        self.send_header( "Connection", "close" )
+        self.end_headers()
+        try :
+            result = job.results.get()
+            while result != None :
+                self.wfile.write( ( json.dumps( result ) + "\n" ).encode( "utf-8" ) )
+                self.wfile.flush()
+                result = job.results.get()
+        except socket.error :
+            logging.debug( "client went away, cancel job" )
+            job.cancelled = True
+
+    def checkMoves( self, game ) :
+        # an illegal move is a bad request, not an error in the middle of the answer
+        board = Board()
+        board.startPosition()
+        for ( moveNumber, color, chessMove ) in game.plies() :
+            try :
+                board.movePgn( chessMove.move, color )
+            except BoardException as e :
+                raise ValueError( "Illegal move %s%s %s: %s" % ( moveNumber, "." if color == "w" else "...", chessMove.move, e ) )
+
+
+class ThreadingHTTPServer( ThreadingMixIn, HTTPServer ) :
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer( ThreadingMixIn, UnixStreamServer ) :
+    daemon_threads = True
+
+
+class AnalysisServer( object ) :
+    """Long running analysis service with a pool of warm engines and a priority job queue"""
+    def __init__( self, enginePath, engineCount = 1, timePerMove = 3.0, engineTimeout = 5.0, engineRetries = 2, engineRestarts = 10 ) :
+        self.timePerMove = timePerMove
+        self.jobs = PriorityQueue()
+        self.sequence = count()
+        self.workers = [ AnalysisWorker( UCIEngine( enginePath, timePerMove, engineTimeout, engineRetries, engineRestarts ), self.jobs ) for i in xrange( engineCount ) ]
+        for worker in self.workers :
+            worker.start()
+
+    def submit( self, job ) :
+        # lower numbers first, jobs of the same priority in order of arrival
+        self.jobs.put( ( job.priority, next( self.sequence ), job ) )
+
+    def serve( self, port = None, socketPath = None ) :
+        if socketPath :
+            if os.path.exists( socketPath ) :
+                if not stat.S_ISSOCK( os.stat( socketPath ).st_mode ) :
+                    self.finish()
+                    raise IOError( "%s exists and is not a socket" % socketPath )
+                os.unlink( socketPath )
+            httpServer = ThreadingUnixHTTPServer( socketPath, AnalysisRequestHandler )
+        else :
+            httpServer = ThreadingHTTPServer( ( "127.0.0.1", port ), AnalysisRequestHandler )
+        httpServer.analysisServer = self
+        logging.info( "analysis server listening on %s" % ( socketPath if socketPath else port ) )
+        try :
+            httpServer.serve_forever()
+        finally :
+            httpServer.server_close()
+            self.finish()
+
+    def finish( self ) :
+        for worker in self.workers :
+            self.jobs.put( ( sys.maxsize, next( self.sequence ), None ) )
+        for worker in self.workers :
+            worker.join()
+            worker.engine.finish()
+
+def testUCIEngine( game, options ) :
+    engine = UCIEngine( options.enginePath, options.timePerMove, options.engineTimeout, options.engineRetries, options.engineRestarts )
+    engine.analyzeGame( game, options.timePerMove, options.annotateWhite, options.annotateBlack, options.scoreThreshold,
+                        options.variationForBadMove, options.analysisFile, options.maxMoves,
+                        createClassifier( options ) if options.nags else None )
+    writeGame( game, options.outputFile )
     engine.finish()
 
+def batchAnalyze( games, options, errors ) :
+    engine = UCIEngine( options.enginePath, options.timePerMove, options.engineTimeout, options.engineRetries, options.engineRestarts )
+    batch = BatchAnalyzer( engine, options.maxMoves )
+    batch.plan( games )
+    errors.extend( batch.errors )
+    resultsFile = None
+    if options.analysisFile :
+        # per position results, kept so a rerun only analyzes positions not stored yet
+        resultsFile = options.analysisFile + ".positions"
+        if os.path.exists( resultsFile ) :
+            batch.loadResults( resultsFile )
+    batch.analyze( resultsFile )
+    engine.finish()
+    gameAnalyses = batch.gameAnalyses()
+    if options.analysisFile :
+        saveAnalysis( gameAnalyses, options.analysisFile )
+    annotateGames( games, gameAnalyses, options, errors )
+    writeGames( games, options.outputFile )
+
+def createClassifier( options ) :
+    return ScoreClassifier( options.inaccuracy, options.mistake, options.blunder )
+
+def annotateGames( games, gameAnalyses, options, errors ) :
+    # a game that can not be annotated is recorded in errors and written without annotations,
+    # with --nags all games are classified in one pass
+    classification = createClassifier( options ).classifyAnalyses( gameAnalyses ) if options.nags else None
+    for ( gameIndex, ( game, analysis ) ) in enumerate( zip( games, gameAnalyses ) ) :
+        try :
+            annotateGame( game, analysis, options.annotateWhite, options.annotateBlack, options.scoreThreshold,
+                          options.variationForBadMove,
+                          classification = classification.classification[ classification.gameSlice( gameIndex ) ].tolist() if classification != None else None )
+        except BoardException as e :
+            index = game.index if game.index != None else gameIndex
+            errors.append( ParseError( index, game.offset, game.line, "Annotation failed: %s" % e, "" ) )
+            logging.warning( "not annotating game %s: %s" % ( index, errors[ -1 ] ) )
+            for ( moveNumber, color, chessMove ) in game.plies() :
+                chessMove.scoreCP = None
+                chessMove.nag = None
+                chessMove.variation = None
+                chessMove.refutation = None
+
+def annotateFromAnalysis( games, options, errors ) :
+    gameAnalyses = loadAnalysis( options.analysisFile )
+    if len( gameAnalyses ) < len( games ) :
+        # games skipped by the batch analysis have no entries, at the end of the input too
+        logging.warning( "Analysis for %s games found in %s, input has %s" % ( len( gameAnalyses ), options.analysisFile, len( games ) ) )
+        gameAnalyses.extend( list() for i in xrange( len( games ) - len( gameAnalyses ) ) )
+    annotateGames( games, gameAnalyses, options, errors )
+    writeGames( games, options.outputFile )
+
 def testBoard(): 
     b = Board()
     b.readFen( b.STARTPOS_FEN )
@@ -818,6 +2271,13 @@ def parsePgnFile( filename ) :
     game.stream( sys.stdout )
     return game
 
+def parsePgnGames( filename, errors = None ) :
+    parser = PgnParser( Scanner( filename ) )
+    games = list( parser.games() )
+    if errors != None :
+        errors.extend( parser.errors )
+    return games
+
 
 # UCI_ENGINE_PATH = "/home/ebayerle/temp/Critter-16a/critter-16a-64bit"
 # UCI_ENGINE_PATH = "/Users/ebayerle/Downloads/stockfish-7-mac/Mac/stockfish-7-64"
@@ -834,9 +2294,30 @@ def parseCommandLineOptions() :
     parser.add_option( "--timePerMove", dest = "timePerMove",
                        type = "float", default = 3.0,
                        help = "seconds per move ply" )
+    parser.add_option( "--engineTimeout", dest = "engineTimeout",
+                       type = "float", default = 5.0,
+                       help = "seconds until a silent engine is restarted" )
+    parser.add_option( "--engineRetries", dest = "engineRetries",
+                       type = "int", default = 2,
+                       help = "engine restarts per position before giving up" )
+    parser.add_option( "--engineRestarts", dest = "engineRestarts",
+                       type = "int", default = 10,
+                       help = "engine restarts in a row without a successful search before giving up" )
     parser.add_option( "--threshold", dest = "scoreThreshold",
                        type = "float", default = 1.1,
                        help = "pawn value difference to annotate" )
+    parser.add_option( "--nags",
+                       action = "store_true", dest = "nags", default = False,
+                       help = "annotate inaccuracies, mistakes and blunders with $6, $2 and $4 instead of using --threshold" )
+    parser.add_option( "--inaccuracy", dest = "inaccuracy",
+                       type = "float", default = ScoreClassifier.INACCURACY_THRESHOLD,
+                       help = "pawns lost by an inaccuracy, for --nags and --columnar" )
+    parser.add_option( "--mistake", dest = "mistake",
+                       type = "float", default = ScoreClassifier.MISTAKE_THRESHOLD,
+                       help = "pawns lost by a mistake, for --nags and --columnar" )
+    parser.add_option( "--blunder", dest = "blunder",
+                       type = "float", default = ScoreClassifier.BLUNDER_THRESHOLD,
+                       help = "pawns lost by a blunder, for --nags and --columnar" )
     parser.add_option( "--variationForBadMove",
                        action = "store_true", dest = "variationForBadMove", default = False,
                        help = "also show how a bad could develop" )
@@ -846,6 +2327,33 @@ def parseCommandLineOptions() :
     parser.add_option( "-b", "--black",
                        action = "store_true", dest = "annotateBlack", default = False,
                        help = "annotate only white players moves" )
+    parser.add_option( "--analysisFile", dest = "analysisFile", default = None,
+                       help = "file to store the raw engine analysis in, or to read it from with --annotateOnly, "
+                              "a rerun continues an interrupted analysis" )
+    parser.add_option( "--annotateOnly",
+                       action = "store_true", dest = "annotateOnly", default = False,
+                       help = "annotate from a stored --analysisFile without running the engine" )
+    parser.add_option( "--batch",
+                       action = "store_true", dest = "batch", default = False,
+                       help = "analyze all games of the input, every distinct position only once" )
+    parser.add_option( "--errorReport", dest = "errorReport", default = None,
+                       help = "with --batch, write the games skipped for syntax errors to this file" )
+    parser.add_option( "--columnar", dest = "columnarBasename", default = None,
+                       help = "also export the analyzed games to <basename>.parquet or <basename>-NNNNN.npz files" )
+    parser.add_option( "--maxMoves", dest = "maxMoves",
+                       type = "int", default = 300,
+                       help = "analyze at most this many moves per game" )
+    parser.add_option( "--server",
+                       action = "store_true", dest = "server", default = False,
+                       help = "run as local analysis service instead of analyzing the input file" )
+    parser.add_option( "--port", dest = "port",
+                       type = "int", default = 8765,
+                       help = "TCP port on localhost for --server" )
+    parser.add_option( "--socket", dest = "socketPath", default = None,
+                       help = "Unix socket for --server instead of the TCP port" )
+    parser.add_option( "--engines", dest = "engineCount",
+                       type = "int", default = 1,
+                       help = "number of engines kept running by --server" )
     parser.add_option( "--debug",
                        action = "store_true", dest = "debug", default = False,
                        help = "enable debug messages" )
@@ -853,10 +2361,17 @@ def parseCommandLineOptions() :
 
     if options.debug :
         logging.basicConfig( level = logging.DEBUG )
-    if options.enginePath == None :
+    if options.annotateOnly :
+        if options.analysisFile == None :
+            parser.error( "Analysis file is missing" )
+    elif options.enginePath == None :
         parser.error( "Engine is missing" )
-    if options.inputFile == None :
+    if options.inputFile == None and not options.server :
         parser.error( "PGN input is missing" )
+    if ( options.nags or options.columnarBasename ) and numpy == None :
+        parser.error( "--nags and --columnar need numpy" )
+    if not options.inaccuracy <= options.mistake <= options.blunder :
+        parser.error( "--inaccuracy, --mistake and --blunder must not decrease" )
     if not options.annotateWhite and not options.annotateBlack :
         options.annotateWhite = True
         options.annotateBlack = True
@@ -866,18 +2381,32 @@ def parseCommandLineOptions() :
 
 def mainEntry() :
     ( options, args ) = parseCommandLineOptions()
-    game = parsePgnFile( options.inputFile )
-    testUCIEngine( game, options )
+    if options.server :
+        server = AnalysisServer( options.enginePath, options.engineCount, options.timePerMove, options.engineTimeout, options.engineRetries,
+                                 options.engineRestarts )
+        server.serve( options.port, options.socketPath )
+        return
+    errors = list()
+    if options.batch :
+        games = parsePgnGames( options.inputFile, errors )
+        if options.annotateOnly :
+            annotateFromAnalysis( games, options, errors )
+        else :
+            batchAnalyze( games, options, errors )
+        if options.errorReport :
+            saveErrorReport( sorted( errors, key = lambda error : error.gameIndex ), options.errorReport )
+    else :
+        games = [ parsePgnFile( options.inputFile ) ]
+        if options.annotateOnly :
+            annotateFromAnalysis( games, options, errors )
+        else :
+            testUCIEngine( games[ 0 ], options )
+    if options.columnarBasename :
+        exportColumnar( games, options.columnarBasename, createClassifier( options ) )
     
-mainEntry()
+if __name__ == "__main__" :
+    mainEntry()
 
-#
-#
-# innaccuracy : 0.50
-# mistake: 1.00
-# blunder: 3.00
-#
-#
 
 
 
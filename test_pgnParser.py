@@ -0,0 +1,268 @@
+##############################################################################################
+#
+#  regression checks, run with: python -m unittest test_pgnParser
+#
+##############################################################################################
+
+import os
+import sys
+import stat
+import shutil
+import tempfile
+import unittest
+
+from pgnParser import PgnParser, Scanner, Board, SanCache, CompactGameStore, PositionIndex, BatchAnalyzer, UCIEngine, \
+                      PlyAnalysis, ScoreClassifier, annotateGames
+
+def parseGames( text ) :
+    parser = PgnParser( Scanner( text = text ) )
+    games = list( parser.games() )
+    return ( games, parser.errors )
+
+def gameMoves( game ) :
+    return [ chessMove.move for ( moveNumber, color, chessMove ) in game.plies() ]
+
+
+class RecoveryTest( unittest.TestCase ) :
+    FOLLOWING = ( '[Event "b"]\n\n1. d4 d5 *\n\n'
+                  '[Event "c"]\n\n1. c4 {fine} e5 *\n\n'
+                  '[Event "d"]\n\n1. e4 c5 *\n' )
+
+    def checkSkipped( self, text, message, offset ) :
+        ( games, errors ) = parseGames( text + self.FOLLOWING )
+        self.assertEqual( [ gameMoves( game ) for game in games ], [ [ "d4", "d5" ], [ "c4", "e5" ], [ "e4", "c5" ] ] )
+        self.assertEqual( [ game.index for game in games ], [ 1, 2, 3 ] )
+        self.assertEqual( [ ( error.gameIndex, error.offset, error.message ) for error in errors ], [ ( 0, offset, message ) ] )
+
+    def testUnclosedComment( self ) :
+        self.checkSkipped( '[Event "a"]\n\n1. e4 {oops e5 *\n\n', "Unclosed comment", 19 )
+
+    def testUnclosedVariation( self ) :
+        self.checkSkipped( '[Event "a"]\n\n1. e4 (1. d4 e5 *\n\n', "Unclosed variation", 19 )
+
+    def testUnclosedTag( self ) :
+        self.checkSkipped( '[Event "a"\n\n1. e4 e5 *\n\n', "Unclosed tag", 0 )
+
+    def testUnexpectedToken( self ) :
+        ( games, errors ) = parseGames( '[Event "a"]\n\n1. e4 e5 garbage *\n\n' + self.FOLLOWING )
+        self.assertEqual( len( games ), 3 )
+        self.assertEqual( [ ( error.line, error.text[ :7 ] ) for error in errors ], [ ( 3, "garbage" ) ] )
+
+    def testWithoutEventTags( self ) :
+        text = ( '[White "x"]\n\n1. e4 e5 *\n\n'
+                 '[White "y"]\n[Black "z"]\n\n1. d4 Qxx *\n\n'
+                 '[White "v"]\n\n1. c4 *\n\n'
+                 '1. Nf3 Nf6 1-0\n\n'
+                 '1. g3 xx 1-0\n\n'
+                 '1. b3 *\n' )
+        ( games, errors ) = parseGames( text )
+        self.assertEqual( [ gameMoves( game ) for game in games ], [ [ "e4", "e5" ], [ "c4" ], [ "Nf3", "Nf6" ], [ "b3" ] ] )
+        self.assertEqual( [ error.gameIndex for error in errors ], [ 1, 4 ] )
+
+    def testMultiLineComments( self ) :
+        ( games, errors ) = parseGames( '1. e4 {a\nmulti line} e5 (1... c5 {x}\n2. Nf3) 2. Nf3 *\n' )
+        self.assertEqual( errors, [] )
+        self.assertEqual( gameMoves( games[ 0 ] ), [ "e4", "e5", "Nf3" ] )
+
+
+class BoardTest( unittest.TestCase ) :
+    PV = "d2d4 d7d5 c1f4 c8f5 b1c3 b8c6 d1d2 d8d7 e1c1 e8c8 h2h3 h7h6 g2g3 h8h7 e2e4 d5e4 d4d5 e7e5 d5e6"
+    SAN = " d4 d5 Bf4 Bf5 Nc3 Nc6 Qd2 Qd7 O-O-O O-O-O h3 h6 g3 Rh7 e4 dxe4 d5 e5 dxe6"
+
+    def testCachedAndUncachedSanAgree( self ) :
+        sanCache = SanCache()
+        for cache in ( None, sanCache, sanCache ) :
+            board = Board()
+            board.startPosition()
+            self.assertEqual( board.transformListofAlgebraicMoveIntoPgn( self.PV, "w", cache ), self.SAN )
+        self.assertTrue( sanCache.hits > 0 )
+
+    def testPgnAndAlgebraicBoardsAgree( self ) :
+        pgnBoard = Board()
+        pgnBoard.startPosition()
+        color = "w"
+        for ( m, algebraicMove ) in zip( self.SAN.split(), self.PV.split() ) :
+            self.assertEqual( pgnBoard.movePgn( m, color ), algebraicMove )
+            color = "b" if color == "w" else "w"
+        board = Board()
+        board.startPosition()
+        board.transformListofAlgebraicMoveIntoPgn( self.PV, "w" )
+        self.assertEqual( pgnBoard.positionHash( color ), board.positionHash( color ) )
+        # the black pawn captured 'en passant' is gone, the a8 rook castled to d8
+        self.assertEqual( pgnBoard.getSquare( ( 5, 5 ) ).figure, " " )
+        self.assertEqual( pgnBoard.getSquare( ( 4, 8 ) ).figure, "r" )
+
+
+class StoreAndIndexTest( unittest.TestCase ) :
+    GAMES = ( '[Event "a"]\n[White "x"]\n\n1. e4 $1 e5 {open} 2. Nf3!? (2. f4 exf4) Nc6 3. Bb5 a6 4. Bxc6+ dxc6 *\n\n'
+              '[Event "b"]\n\n1. d4 d5 2. c4 e6 3. Nc3 Nf6 4. Nf3 Be7 1/2-1/2\n\n'
+              '[Event "c"]\n\n1. Nf3 d5 2. d4 Nf6 3. c4 e6 4. Nc3 Be7 5. Qd3 Qd6 6. Qxh7 Rxh7 0-1\n\n'
+              '[Event "d"]\n\n1. e4 d5 2. e5 f5 3. exf6 gxf6 4. Qh5# 1-0\n' )
+
+    def setUp( self ) :
+        self.directory = tempfile.mkdtemp()
+        ( self.games, errors ) = parseGames( self.GAMES )
+        self.assertEqual( errors, [] )
+
+    def tearDown( self ) :
+        shutil.rmtree( self.directory )
+
+    def testStoreRoundTrip( self ) :
+        store = CompactGameStore()
+        for game in self.games :
+            store.addGame( game )
+        filename = os.path.join( self.directory, "games.cgs" )
+        store.save( filename )
+        loaded = CompactGameStore.load( filename )
+        self.assertEqual( len( loaded ), len( self.games ) )
+        for ( i, game ) in enumerate( self.games ) :
+            restored = loaded[ i ].toChessGame()
+            self.assertEqual( restored.tags, game.tags )
+            self.assertEqual( [ ( m.move, m.comments ) for ( n, c, m ) in restored.plies() ],
+                              [ ( m.move, m.comments ) for ( n, c, m ) in game.plies() ] )
+
+    def testChunkedIndex( self ) :
+        single = PositionIndex.build( self.games, os.path.join( self.directory, "single.idx" ) )
+        chunked = PositionIndex.build( self.games, os.path.join( self.directory, "chunked.idx" ), chunkSize = 3 )
+        self.assertEqual( [ single.record( i ) for i in xrange( len( single ) ) ],
+                          [ chunked.record( i ) for i in xrange( len( chunked ) ) ] )
+        for index in ( single, chunked ) :
+            self.assertEqual( index.findFen( Board.STARTPOS_FEN ), [ ( 0, 0 ), ( 1, 0 ), ( 2, 0 ), ( 3, 0 ) ] )
+            # game c transposes into game b
+            self.assertEqual( index.findLine( "d4 d5 c4 e6 Nc3 Nf6 Nf3 Be7" ), [ ( 1, 8 ), ( 2, 8 ) ] )
+            self.assertEqual( index.findLine( "e4 d5 e5 f5 exf6" ), [ ( 3, 5 ) ] )
+            index.close()
+        self.assertEqual( sorted( os.listdir( self.directory ) ), [ "chunked.idx", "single.idx" ] )
+
+    def testIndexSkipsIllegalGames( self ) :
+        ( games, errors ) = parseGames( '1. e4 Nf3 *\n\n1. d4 *\n' )
+        errors = list()
+        index = PositionIndex.build( games, os.path.join( self.directory, "x.idx" ), chunkSize = 1, errors = errors )
+        self.assertEqual( index.findLine( "d4" ), [ ( 1, 1 ) ] )
+        self.assertEqual( [ error.gameIndex for error in errors ], [ 0 ] )
+        index.close()
+        self.assertEqual( os.listdir( self.directory ), [ "x.idx" ] )
+
+
+class FakeEngine( object ) :
+    """Stands in for UCIEngine, the score of a position is its number of moves"""
+    def __init__( self ) :
+        self.paths = list()
+
+    def newGame( self ) :
+        pass
+
+    def analyzePosition( self, algebraicMoves ) :
+        self.paths.append( list( algebraicMoves ) )
+        self.scoreCP = len( algebraicMoves ) / 10.0
+        self.pv = ""
+        self.depth = 1
+
+
+class BatchTest( unittest.TestCase ) :
+    def testFanOut( self ) :
+        ( games, errors ) = parseGames( '1. e4 e5 2. Nf3 *\n\n1. e4 e5 2. Nf3 Nc6 *\n\n1. e4 Nf3 *\n\n'
+                                        '1. Nf3 Nf6 2. Ng1 Ng8 3. e4 *\n' )
+        engine = FakeEngine()
+        batch = BatchAnalyzer( engine )
+        batch.plan( games )
+        batch.analyze()
+        # shared plies are analyzed once, the start position because the last game returns to it
+        self.assertEqual( sorted( len( path ) for path in engine.paths ), [ 0, 1, 1, 2, 2, 3, 3, 4 ] )
+        self.assertEqual( [ error.gameIndex for error in batch.errors ], [ 2 ] )
+        gameAnalyses = batch.gameAnalyses()
+        self.assertEqual( [ len( analysis ) for analysis in gameAnalyses ], [ 3, 4, 0, 5 ] )
+        self.assertEqual( [ plyAnalysis.scoreCP for plyAnalysis in gameAnalyses[ 1 ] ], [ -0.1, 0.2, -0.3, 0.4 ] )
+        # 1. e4 after the knights went back is the position after 1. e4
+        self.assertEqual( gameAnalyses[ 3 ][ 4 ].scoreCP, -0.1 )
+
+    def testCastlingRightsInKey( self ) :
+        ( games, errors ) = parseGames( '1. e4 e5 2. Ke2 Ke7 3. Ke1 Ke8 *\n' )
+        batch = BatchAnalyzer( FakeEngine() )
+        batch.plan( games )
+        keys = [ plies[ 0 ] for plies in batch.gamePlies[ 0 ] ]
+        self.assertEqual( len( set( keys ) ), 6 )
+
+
+class AnnotationOptions( object ) :
+    annotateWhite = True
+    annotateBlack = True
+    scoreThreshold = 1.1
+    variationForBadMove = False
+    nags = True
+    inaccuracy = ScoreClassifier.INACCURACY_THRESHOLD
+    mistake = ScoreClassifier.MISTAKE_THRESHOLD
+    blunder = ScoreClassifier.BLUNDER_THRESHOLD
+
+
+class AnnotationTest( unittest.TestCase ) :
+    def testBadGameDoesNotStopTheOthers( self ) :
+        ( games, errors ) = parseGames( '1. e4 e5 2. Qh5 *\n\n1. d4 d5 2. Bg5 *\n' )
+        gameAnalyses = [ [ PlyAnalysis( 0, "1", "w", "e4", "e2e4", 0.2, "", 1 ),
+                           # the pv shown for the mistake 2. Qh5 is not legal in this position
+                           PlyAnalysis( 1, "1", "b", "e5", "e7e5", 0.2, "a1a8", 1 ),
+                           PlyAnalysis( 2, "2", "w", "Qh5", "d1h5", -1.0, "", 1 ) ],
+                         [ PlyAnalysis( 0, "1", "w", "d4", "d2d4", 0.2, "", 1 ),
+                           PlyAnalysis( 1, "1", "b", "d5", "d7d5", 0.8, "g1f3", 1 ),
+                           PlyAnalysis( 2, "2", "w", "Bg5", "c1g5", -3.0, "g8f6", 1 ) ] ]
+        annotateGames( games, gameAnalyses, AnnotationOptions(), errors )
+        self.assertEqual( [ error.gameIndex for error in errors ], [ 0 ] )
+        self.assertEqual( [ m.scoreCP for ( n, c, m ) in games[ 0 ].plies() ], [ None, None, None ] )
+        # inaccuracy $6 of black, blunder $4 of white
+        self.assertEqual( [ m.nag for ( n, c, m ) in games[ 1 ].plies() ], [ None, 6, 4 ] )
+        self.assertEqual( games[ 1 ].moves[ 1 ].white.variation, " 2. Nf3" )
+
+
+class EngineTest( unittest.TestCase ) :
+    # a UCI engine that hangs in the middle of a line on the first search after it was installed
+    SCRIPT = """#!%s
+import sys, os, time
+marker = __file__ + ".hung"
+while True :
+    line = sys.stdin.readline()
+    if not line :
+        break
+    line = line.strip()
+    if line == "uci" :
+        sys.stdout.write( "uci" )
+        sys.stdout.flush()
+        sys.stdout.write( "ok\\n" )
+    elif line == "isready" :
+        sys.stdout.write( "readyok\\n" )
+    elif line.startswith( "go" ) :
+        if not os.path.exists( marker ) :
+            open( marker, "w" ).close()
+            sys.stdout.write( "info depth 3" )
+            sys.stdout.flush()
+            time.sleep( 30 )
+        sys.stdout.write( "info depth 10 score cp 25 pv e7e5\\n" )
+    elif line == "stop" :
+        sys.stdout.write( "bestmove e7e5\\n" )
+    elif line == "quit" :
+        break
+    sys.stdout.flush()
+"""
+
+    def setUp( self ) :
+        self.directory = tempfile.mkdtemp()
+        self.enginePath = os.path.join( self.directory, "engine.py" )
+        f = open( self.enginePath, "w" )
+        f.write( self.SCRIPT % sys.executable )
+        f.close()
+        os.chmod( self.enginePath, stat.S_IRWXU )
+
+    def tearDown( self ) :
+        shutil.rmtree( self.directory )
+
+    def testPartialLineTimesOut( self ) :
+        engine = UCIEngine( self.enginePath, timePerMove = 0.05, readyTimeout = 0.5, maxRetries = 1 )
+        engine.analyzePosition( [ "e2e4" ] )
+        engine.finish()
+        self.assertEqual( engine.scoreCP, 0.25 )
+        self.assertEqual( engine.pv, " e7e5" )
+        self.assertEqual( engine.restarts, 0 )
+        self.assertTrue( os.path.exists( self.enginePath + ".hung" ) )
+
+
+if __name__ == "__main__" :
+    unittest.main()